@@ -7,7 +7,7 @@ __license__ = 'GPL v3'
 __copyright__ = '2011, Grant Drake <grant.drake@gmail.com>, 2016-2020 updates by David Forrester <davidfor@internode.on.net>'
 __docformat__ = 'restructuredtext en'
 
-import time, json, re
+import json, re
 try:
     from urllib.parse import quote
 except ImportError:
@@ -16,6 +16,7 @@ try:
     from queue import Empty, Queue
 except ImportError:
     from Queue import Empty, Queue
+from concurrent.futures import wait, FIRST_COMPLETED
 import six
 from six import text_type as unicode
 
@@ -47,6 +48,7 @@ class Goodreads(Source):
     ID_NAME = 'goodreads'
     BASE_URL = 'https://www.goodreads.com'
     MAX_EDITIONS = 5
+    MIN_COVER_SIZE = 1000
 
     def config_widget(self):
         '''
@@ -102,6 +104,11 @@ class Goodreads(Source):
                 goodreads_id = self.cached_isbn_to_identifier(isbn)
         if goodreads_id is not None:
             url = self.cached_identifier_to_cover_url(goodreads_id)
+            if url is None:
+                from calibre_plugins.goodreads.covers import get_cover_store
+                url = get_cover_store().url_for_id(goodreads_id)
+                if url is not None:
+                    self.cache_identifier_to_cover_url(goodreads_id, url)
 
         return url
 
@@ -116,17 +123,33 @@ class Goodreads(Source):
         mi.authors = fixauthors(mi.authors)
         mi.isbn = check_isbn(mi.isbn)
 
-    def get_goodreads_id_using_api(self, log, abort, timeout=30, identifier=None):
-        
+    def _debug_log(self, log, settings=None):
+        '''
+        Debug output in the per result loops, see worker.DebugLog
+        '''
+        from calibre_plugins.goodreads.worker import DebugLog
+        if settings is None:
+            import calibre_plugins.goodreads.config as cfg
+            settings = cfg.get_settings()
+        return DebugLog(log, settings.debug_logging)
+
+    def get_goodreads_id_using_api(self, log, abort, timeout=30, identifier=None, settings=None):
+        from calibre_plugins.goodreads.fetcher import get_fetcher
+        from calibre_plugins.goodreads.idindex import get_identifier_index
+
         log.debug('get_goodreads_id_using_api - identifiers=%s' % identifier)
         
         if not identifier:
             return None
         
-        goodreads_id = None
+        index = get_identifier_index()
+        known, goodreads_id = index.lookup(identifier.strip().upper())
+        if known:
+            log.info('Result using identifier index: %s' % goodreads_id)
+            return goodreads_id
         
         br = self.browser
-        autocomplete_api_url = "https://www.goodreads.com/book/auto_complete?format=json&q="
+        autocomplete_api_url = Goodreads.BASE_URL + "/book/auto_complete?format=json&q="
         query = autocomplete_api_url + identifier
 
         if abort.is_set():
@@ -134,8 +157,8 @@ class Goodreads(Source):
        
         try:
             log.info('Querying using autocomplete API: %s' % query)
-            raw = br.open_novisit(query, timeout=timeout).read()
-            log.debug('JSON Result: %s'%raw)
+            raw = get_fetcher().fetch(br, query, timeout=timeout, log=log, abort=abort)
+            self._debug_log(log, settings)('JSON Result: %s', raw)
         except Exception as e:
             err = 'Failed to make identify query: %r' % query
             log.exception(err)
@@ -146,36 +169,44 @@ class Goodreads(Source):
             if len(json_result) >= 1:
                 goodreads_id = json_result[0].get('bookId', None)
         log.info('Result using autocomplete API: %s' % goodreads_id)
+        index.record(identifier.strip().upper(), goodreads_id)
         return goodreads_id
         
         
-    def get_goodreads_id_using_asin(self, log, abort, timeout=30, identifiers={}):
+    def get_goodreads_id_using_asin(self, log, abort, timeout=30, identifiers={}, settings=None):
+        from calibre_plugins.goodreads.idindex import is_amazon_identifier
         for identifier_name, identifier in identifiers.items():
-            identifier_name = identifier_name.lower()
-            if identifier_name in ('amazon', 'asin', 'mobi-asin') or identifier_name.startswith('amazon_'):
+            if is_amazon_identifier(identifier_name):
                 log.info('get_goodreads_id_using_asin - identifier_name=%s, identifier=%s' % (identifier_name, identifier))
-                goodreads_id = self.get_goodreads_id_using_api(log, abort, timeout=timeout, identifier=identifier)
+                goodreads_id = self.get_goodreads_id_using_api(log, abort, timeout=timeout,
+                        identifier=identifier, settings=settings)
                 return goodreads_id
         return None
 
 
-    def get_goodreads_id_from_identifiers(self, log, abort, timeout=30, identifiers={}):
+    def get_goodreads_id_from_identifiers(self, log, abort, timeout=30, identifiers={}, settings=None):
         '''
         Note this method will retry without identifiers automatically if no
         match is found with identifiers.
         '''
+        from calibre_plugins.goodreads.idindex import get_identifier_index
         goodreads_id = identifiers.get(self.ID_NAME, None)
         if goodreads_id:
+            # Books already matched to Goodreads tell us the answer for their
+            # ISBN/ASIN, which saves an API call for other copies of the book
+            get_identifier_index().record_identifiers(identifiers)
             return goodreads_id
         
         isbn = check_isbn(identifiers.get('isbn', None))
         if isbn:
             log.info('get_goodreads_id_from_identifiers - isbn=%s' % isbn)
-            goodreads_id = self.get_goodreads_id_using_api(log, abort, timeout=timeout, identifier=isbn)
+            goodreads_id = self.get_goodreads_id_using_api(log, abort, timeout=timeout,
+                    identifier=isbn, settings=settings)
         if goodreads_id:
             return goodreads_id
 
-        goodreads_id = self.get_goodreads_id_using_asin(log, abort, timeout=timeout, identifiers=identifiers)
+        goodreads_id = self.get_goodreads_id_using_asin(log, abort, timeout=timeout,
+                identifiers=identifiers, settings=settings)
         if goodreads_id:
             return goodreads_id
 
@@ -188,6 +219,21 @@ class Goodreads(Source):
         Note this method will retry without identifiers automatically if no
         match is found with identifiers.
         '''
+        from calibre_plugins.goodreads import stats
+        import calibre_plugins.goodreads.config as cfg
+        # Every option this run uses is read here, once
+        settings = cfg.get_settings()
+        collecting = stats.begin_run(settings)
+        try:
+            stats.count('books')
+            return self._identify(log, result_queue, abort, settings, title=title,
+                                  authors=authors, identifiers=identifiers, timeout=timeout)
+        finally:
+            if collecting:
+                stats.end_run(log)
+
+    def _identify(self, log, result_queue, abort, settings, title=None, authors=None,
+            identifiers={}, timeout=30):
         matches = []
         goodreads_id = None
         log.debug('identify - start. title=%s, authors=%s, identifiers=%s' % (title, authors, identifiers))
@@ -197,7 +243,8 @@ class Goodreads(Source):
         # to get the Goodreads ID via an API if we don't already have it.
         try:
             if identifiers:
-                goodreads_id = self.get_goodreads_id_from_identifiers(log, abort, timeout=timeout, identifiers=identifiers)
+                goodreads_id = self.get_goodreads_id_from_identifiers(log, abort, timeout=timeout,
+                        identifiers=identifiers, settings=settings)
         except Exception as e:
             err = 'Failed to trying to get Goodreads id using auto_complete API'
             log.exception(err)
@@ -214,61 +261,106 @@ class Goodreads(Source):
             if query is None:
                 log.error('Insufficient metadata to construct query')
                 return
-            try:
-                log.info('Querying: %s' % query)
-                response = br.open_novisit(query, timeout=timeout)
-            except Exception as e:
-                err = 'Failed to make identify query: %r' % query
-                log.exception(err)
-                return as_unicode(e)
-
-            log.info('no isbn')
-            try:
-                raw = response.read().strip()
-                #open('E:\\t.html', 'wb').write(raw)
-                raw = raw.decode('utf-8', errors='replace')
-                if not raw:
-                    log.error('Failed to get raw result for query: %r' % query)
-                    return
-                root = fromstring(clean_ascii_chars(raw))
-                log.debug('response: %s' % root)
-            except:
-                msg = 'Failed to parse goodreads page for query: %r' % query
-                log.exception(msg)
-                return msg
+            root, err = self._fetch_search_page(log, abort, br, query, timeout, settings)
+            if root is None:
+                return err
             # Now grab the first value from the search results, provided the
             # title and authors appear to be for the same book
-            self._parse_search_results(log, title, authors, root, matches, timeout)
+            self._parse_search_results(log, title, authors, root, matches, timeout, settings)
 
         if abort.is_set():
             return
 
         from calibre_plugins.goodreads.worker import Worker
-        workers = [Worker(url, result_queue, br, log, i, self) for i, url in
-                enumerate(matches)]
-
-        for w in workers:
-            w.start()
-            # Don't send all requests at the same time
-            time.sleep(0.1)
-
-        while not abort.is_set():
-            a_worker_is_alive = False
-            for w in workers:
-                w.join(0.2)
-                if abort.is_set():
-                    break
-                if w.is_alive():
-                    a_worker_is_alive = True
-            if not a_worker_is_alive:
-                break
+        from calibre_plugins.goodreads.throttle import get_executor
+        workers = [Worker(url, result_queue, br, log, i, self, settings=settings)
+                   for i, url in enumerate(matches)]
+
+        # The executor is shared with every other identify running in this
+        # process, and the fetcher paces the requests actually sent, so there
+        # is no need to stagger the workers here.
+        executor = get_executor(settings.max_downloads)
+        pending = set(executor.submit(w.run) for w in workers)
+        while pending and not abort.is_set():
+            done, pending = wait(pending, timeout=0.2, return_when=FIRST_COMPLETED)
+        for f in pending:
+            f.cancel()
 
         return None
 
-    def _parse_search_results(self, log, orig_title, orig_authors, root, matches, timeout):
+    def identify_batch(self, log, books, abort, timeout=30):
+        '''
+        Identify many books at once. books is a list of (title, authors,
+        identifiers) tuples and the result is a list, in the same order, of
+        the list of Metadata objects found for each book. See batch.py
+        '''
+        from calibre_plugins.goodreads import stats
+        from calibre_plugins.goodreads.batch import BatchIdentifier
+        import calibre_plugins.goodreads.config as cfg
+        settings = cfg.get_settings()
+        collecting = stats.begin_run(settings)
+        try:
+            stats.count('books', len(books))
+            return BatchIdentifier(self, log, abort, timeout=timeout,
+                                   settings=settings).identify(books)
+        finally:
+            if collecting:
+                stats.end_run(log)
+
+    def _fetch_search_page(self, log, abort, br, query, timeout, settings=None):
+        '''
+        Returns a tuple of (root, error). root is None if the page could not
+        be downloaded or parsed, in which case error is the message for calibre.
+        '''
+        from calibre_plugins.goodreads import stats
+        from calibre_plugins.goodreads.fetcher import get_fetcher
+        try:
+            log.info('Querying: %s' % query)
+            raw = get_fetcher().fetch(br, query, timeout=timeout, log=log, abort=abort)
+        except Exception as e:
+            err = 'Failed to make identify query: %r' % query
+            log.exception(err)
+            return (None, as_unicode(e))
+
+        log.info('no isbn')
+        try:
+            raw = raw.strip()
+            #open('E:\\t.html', 'wb').write(raw)
+            raw = raw.decode('utf-8', errors='replace')
+            if not raw:
+                log.error('Failed to get raw result for query: %r' % query)
+                return (None, None)
+            with stats.timer('parse_search'):
+                root = fromstring(clean_ascii_chars(raw))
+            self._debug_log(log, settings)('response: %s', root)
+        except:
+            msg = 'Failed to parse goodreads page for query: %r' % query
+            log.exception(msg)
+            return (None, msg)
+        return (root, None)
+
+    def _parse_search_results(self, log, orig_title, orig_authors, root, matches, timeout, settings):
+        from calibre_plugins.goodreads import stats
+        with stats.timer('search_matches'):
+            search_matches, editions_url, title_tokens = self._find_search_matches(log, orig_title,
+                    orig_authors, root, settings)
+        matches.extend(search_matches)
+        if editions_url is not None:
+            self._parse_editions_for_book(log, editions_url, matches, timeout, title_tokens, settings)
+
+    def _find_search_matches(self, log, orig_title, orig_authors, root, settings):
+        '''
+        Returns a tuple of (matches, editions_url, title_tokens). If
+        editions_url is not None the editions page still has to be scanned
+        for further matches, see _parse_editions_for_book.
+        '''
+        from calibre_plugins.goodreads import stats
+        from calibre_plugins.goodreads.ranking import rank, search_result_for_row
+        matches = []
         first_result = root.xpath('//table[@class="tableList"]/tr/td[2]')
         if not first_result:
-            return
+            return (matches, None, [])
+        debug = self._debug_log(log, settings)
         title_tokens = list(self.get_title_tokens(orig_title))
         author_tokens = list(self.get_author_tokens(orig_authors))
 
@@ -288,55 +380,36 @@ class Goodreads(Source):
             if not author_tokens: amatch = True
             return match and amatch
 
-        i = 0
-        for result in first_result:
-            title = result.xpath('./a')[0].text_content().strip()
-            authors = result.xpath('./span[@itemprop="author"]/div/a/span')[0].text_content().strip().split(',')
-            if ismatch(title, authors):
-                log.info('Found match: %d %s %s' % (i, title, authors))
-
-#                 log.debug('_parse_search_results: 1 result: %s' % (tostring(result).strip(), ))
-#                 log.debug('_parse_search_results: 1 first_result[i]: %s' % (tostring(first_result[i]).strip(), ))
-                book_details_node = first_result[i].xpath('./div')
-                book_details_node = result.xpath('./div')
-#                 log.debug("_parse_search_results: 2 './div'[-1]: %s" % (tostring(book_details_node[-1]).strip(), ))
-#                 log.debug("_parse_search_results: 3 './div'[0]: %s" % (tostring(book_details_node[0]).strip(), ))
-#                 book_details_node1 = book_details_node[-1].xpath('./span')
-#                 log.debug("_parse_search_results: 3 './span': %s" % (book_details_node1[0], ))
-#                 book_details_node1 = book_details_node[-1].xpath('./span/a')
-#                 log.debug("_parse_search_results: 4 './span/a': %s" % (book_details_node1[0], ))
-#                 book_details_node1 = book_details_node[-1].xpath('./span/a/@href')
-#                 log.debug("_parse_search_results: 5 ./span/a/@href: %s" % (book_details_node1[0], ))
-                if book_details_node:
-                    import calibre_plugins.goodreads.config as cfg
-                    c = cfg.plugin_prefs[cfg.STORE_NAME]
-#                     log.debug("_parse_search_results: c[cfg.KEY_GET_EDITIONS] %s" % (c[cfg.KEY_GET_EDITIONS], ))
-                    if c[cfg.KEY_GET_EDITIONS]:
-                        # We need to read the editions for this book and get the matches from those
-                        log.debug("_parse_search_results: trying to get editions...")
-                        for editions_text in book_details_node[0].xpath('./span/a[@href]/text()'):
-                            log.debug("_parse_search_results: looping on editions_text=%s" % (editions_text,))
-                            #editions_text = tostring(editions_node, method='text').strip()
-                            if editions_text == '1 edition':
-                                # There is no point in doing the extra hop
-                                log.info('Not scanning editions as only one edition found')
-                                break
-                            #editions_url = Goodreads.BASE_URL + editions_node.get('href')
-                            editions_url = Goodreads.BASE_URL + editions_text.getparent().get('href')
-                            log.debug("_parse_search_results: editions_url= %s" % (editions_url, ))
-                            if '/work/editions/' in editions_url:
-                                log.info('Examining up to %s: %s' % (editions_text, editions_url))
-                                self._parse_editions_for_book(log, editions_url, matches, timeout, title_tokens)
-                                return
-                    main_book_link = first_result[i].xpath('./a/@href')
-                    log.debug("_parse_search_results: not using editions -'./a/@href': %s" % (main_book_link[0], ))
-                    result_url = Goodreads.BASE_URL + first_result[i].xpath('./a/@href')[0]
-                    matches.append(result_url)
-#                 break
-            i += 1
-
-    def _parse_editions_for_book(self, log, editions_url, matches, timeout, title_tokens):
-        log.debug("_parse_editions_for_book: Start")
+        results = []
+        for i, row in enumerate(first_result):
+            result = search_result_for_row(row, Goodreads.BASE_URL)
+            if result is not None and ismatch(result.title, result.authors):
+                log.info('Found match: %d %s %s' % (i, result.title, result.authors))
+                results.append(result)
+
+        # Every match used to get a detail page, now only the best few do
+        ranked, skipped = rank(results, title_tokens, author_tokens, settings.max_candidates)
+        stats.count('search_candidates', len(results))
+        stats.count('detail_fetches_avoided', skipped)
+        if skipped:
+            log.info('Using the best %d of %d matches' % (len(ranked), len(results)))
+        for score, result in ranked:
+            debug('_find_search_matches: score=%.2f ratings=%d year=%s url=%s',
+                  score, result.ratings, result.year, result.url)
+            if settings.get_editions:
+                # We need to read the editions for this book and get the matches from those
+                if result.editions_url is not None:
+                    log.info('Examining up to %s: %s' % (result.editions_text, result.editions_url))
+                    return (matches, result.editions_url, title_tokens)
+                if result.editions_text == '1 edition':
+                    # There is no point in doing the extra hop
+                    log.info('Not scanning editions as only one edition found')
+            matches.append(result.url)
+        return (matches, None, title_tokens)
+
+    def _parse_editions_for_book(self, log, editions_url, matches, timeout, title_tokens, settings):
+        debug = self._debug_log(log, settings)
+        debug("_parse_editions_for_book: Start")
 
         def ismatch(title):
             title = lower(title)
@@ -347,45 +420,31 @@ class Goodreads(Source):
                     break
             return match
 
-        br = self.browser
-        try:
-            raw = br.open_novisit(editions_url, timeout=timeout).read().strip()
-        except Exception as e:
-            err = 'Failed identify editions query: %r' % editions_url
-            log.exception(err)
-            return as_unicode(e)
-        try:
-            raw = raw.decode('utf-8', errors='replace')
-            if not raw:
-                log.error('Failed to get raw result for query: %r' % editions_url)
-                return
-            #open('E:\\s.html', 'wb').write(raw)
-            root = fromstring(clean_ascii_chars(raw))
-        except:
-            msg = 'Failed to parse goodreads page for query: %r' % editions_url
-            log.exception(msg)
-            return msg
+        editions = self._get_editions(log, editions_url, timeout)
+        if not isinstance(editions, list):
+            return editions
 
         first_non_valid = None
-        for div_link in root.xpath('//div[@class="editionData"]/div[1]/a[@class="bookTitle"]'):
-            title = div_link.text.strip().lower()
-            log.debug('title: %r' % title)
+        for edition in editions:
+            title = edition.title.lower()
+            debug('title: %r', title)
             if title:
                 # Verify it is not an audio edition
                 valid_title = True
-                for exclusion in ['(audio cd)', '(compact disc)', '(audio cassette)']:
-                    if exclusion in title:
+                book_format = (edition.format or '').lower()
+                for exclusion in ['audio cd', 'compact disc', 'audio cassette']:
+                    if '(%s)' % exclusion in title or book_format == exclusion:
                         log.info('Skipping audio edition: %s' % title)
                         valid_title = False
                         if first_non_valid is None:
-                            first_non_valid = Goodreads.BASE_URL + div_link.get('href')
+                            first_non_valid = Goodreads.BASE_URL + edition.url
                         break
                 if valid_title:
                     # Verify it is not a foreign language edition
                     if not ismatch(title):
                         log.info('Skipping alternate title:', title)
                         continue
-                    matches.append(Goodreads.BASE_URL + div_link.get('href'))
+                    matches.append(Goodreads.BASE_URL + edition.url)
                     if len(matches) >= Goodreads.MAX_EDITIONS:
                         return
         if len(matches) == 0 and first_non_valid:
@@ -394,9 +453,69 @@ class Goodreads(Source):
             log.info('Choosing the first audio edition as no others found.')
             matches.append(first_non_valid)
 
+    def _get_editions(self, log, editions_url, timeout):
+        '''
+        The editions of the work, from the editions cache when it has them.
+        Returns an error message if the editions page could not be read.
+        '''
+        from calibre_plugins.goodreads import stats
+        from calibre_plugins.goodreads.editions import (get_editions_cache,
+                parse_editions_page, work_id_for_url)
+        from calibre_plugins.goodreads.fetcher import get_fetcher
+        work_id = work_id_for_url(editions_url)
+        if work_id is not None:
+            editions = get_editions_cache().get(work_id)
+            if editions is not None:
+                log.info('Using cached editions for work: %s' % work_id)
+                return editions
+
+        br = self.browser
+        try:
+            raw = get_fetcher().fetch(br, editions_url, timeout=timeout, log=log).strip()
+        except Exception as e:
+            err = 'Failed identify editions query: %r' % editions_url
+            log.exception(err)
+            return as_unicode(e)
+        try:
+            raw = raw.decode('utf-8', errors='replace')
+            if not raw:
+                log.error('Failed to get raw result for query: %r' % editions_url)
+                return
+            #open('E:\\s.html', 'wb').write(raw)
+            with stats.timer('parse_editions'):
+                root = fromstring(clean_ascii_chars(raw))
+        except:
+            msg = 'Failed to parse goodreads page for query: %r' % editions_url
+            log.exception(msg)
+            return msg
+
+        with stats.timer('extract_editions'):
+            editions = parse_editions_page(root)
+        if work_id is not None and editions:
+            get_editions_cache().put(work_id, editions)
+        return editions
+
     def download_cover(self, log, result_queue, abort,
             title=None, authors=None, identifiers={}, timeout=30):
+        from calibre_plugins.goodreads import stats
+        import calibre_plugins.goodreads.config as cfg
+        settings = cfg.get_settings()
+        collecting = stats.begin_run(settings)
+        try:
+            return self._download_cover(log, result_queue, abort, settings, title=title,
+                    authors=authors, identifiers=identifiers, timeout=timeout)
+        finally:
+            if collecting:
+                stats.end_run(log)
+
+    def _download_cover(self, log, result_queue, abort, settings,
+            title=None, authors=None, identifiers={}, timeout=30):
         cached_url = self.get_cached_cover_url(identifiers)
+        goodreads_id = identifiers.get(self.ID_NAME, None)
+        if cached_url is None and goodreads_id:
+            # No need for a full identify, the book page has the cover
+            log.info('No cached cover found, reading the book page')
+            cached_url = self._cover_url_for_goodreads_id(log, goodreads_id, abort, timeout, settings)
         if cached_url is None:
             log.info('No cached cover found, running identify')
             rq = Queue()
@@ -422,13 +541,52 @@ class Goodreads(Source):
 
         if abort.is_set():
             return
-        br = self.browser
-        log('Downloading cover from:', cached_url)
-        try:
-            cdata = br.open_novisit(cached_url, timeout=timeout).read()
+        from calibre_plugins.goodreads.covers import download_cover
+        cdata = download_cover(self.browser, cached_url, log, abort=abort, timeout=timeout,
+                               min_size=self.MIN_COVER_SIZE)
+        if cdata is not None:
             result_queue.put((self, cdata))
-        except:
-            log.exception('Failed to download cover from:', cached_url)
+
+    def _cover_url_for_goodreads_id(self, log, goodreads_id, abort, timeout=30, settings=None):
+        from calibre_plugins.goodreads.worker import Worker
+        if abort.is_set():
+            return None
+        url = '%s/book/show/%s' % (Goodreads.BASE_URL, goodreads_id)
+        Worker(url, Queue(), self.browser, log, 0, self, timeout=timeout, settings=settings).run()
+        return self.get_cached_cover_url({self.ID_NAME: goodreads_id})
+
+    def prefetch_covers(self, log, identifiers_list, abort, timeout=30):
+        '''
+        Download the covers of many books in parallel into the cover store,
+        so download_cover finds them there. Books without a goodreads
+        identifier or a cached cover URL are skipped. Returns the number of
+        covers available.
+        '''
+        from calibre_plugins.goodreads.covers import download_cover
+        from calibre_plugins.goodreads.throttle import get_executor
+        import calibre_plugins.goodreads.config as cfg
+        br = self.browser
+        settings = cfg.get_settings()
+
+        def prefetch(identifiers):
+            url = self.get_cached_cover_url(identifiers)
+            goodreads_id = identifiers.get(self.ID_NAME, None)
+            if url is None and goodreads_id:
+                url = self._cover_url_for_goodreads_id(log, goodreads_id, abort, timeout, settings)
+            if url is None or abort.is_set():
+                return False
+            return download_cover(br, url, log, abort=abort, timeout=timeout,
+                                  min_size=self.MIN_COVER_SIZE) is not None
+
+        executor = get_executor(settings.max_downloads)
+        pending = set(executor.submit(prefetch, identifiers) for identifiers in identifiers_list)
+        found = 0
+        while pending and not abort.is_set():
+            done, pending = wait(pending, timeout=0.2, return_when=FIRST_COMPLETED)
+            found += sum(1 for f in done if not f.exception() and f.result())
+        for f in pending:
+            f.cancel()
+        return found
 
 
 if __name__ == '__main__': # tests
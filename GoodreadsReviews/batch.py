@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2011, Grant Drake <grant.drake@gmail.com>, 2016-2020 updates by David Forrester <davidfor@internode.on.net>'
+__docformat__ = 'restructuredtext en'
+
+import re
+from threading import Condition, Lock
+try:
+    from queue import Empty, Queue
+except ImportError:
+    from Queue import Empty, Queue
+
+from calibre.ebooks import normalize
+
+import calibre_plugins.goodreads.config as cfg
+from calibre_plugins.goodreads.throttle import get_executor
+
+STAGES = ('resolve', 'search', 'editions', 'details')
+
+
+class _Book(object):
+
+    def __init__(self, index, title, authors, identifiers):
+        self.index = index
+        self.title, self.authors = title, authors
+        self.identifiers = identifiers or {}
+        self.results = []
+        self.pending_details = 0
+        self.finished = False
+
+
+class BatchIdentifier(object):
+
+    '''
+    Identify a whole batch of books with the stages of identify (goodreads id
+    resolution, search page, editions page and detail pages) running as a
+    pipeline on the executor shared with identify, see throttle.get_executor,
+    so a batch stays within "Maximum simultaneous downloads" whatever else is
+    running. One book can be downloading its detail pages while the next is
+    still being searched for.
+
+    Identical searches, editions scans and detail pages are only done once for
+    the whole batch; every book asking for them gets the shared result.
+    '''
+
+    def __init__(self, plugin, log, abort, timeout=30, settings=None):
+        self.plugin, self.log, self.abort = plugin, log, abort
+        self.timeout = timeout
+        # The whole batch runs with the options it started with
+        self.settings = settings if settings is not None else cfg.get_settings()
+        self.executor = get_executor(self.settings.max_downloads)
+        self.inflight = dict((stage, {}) for stage in STAGES)
+        self.lock = Lock()
+        self.finished = Condition(self.lock)
+        self.remaining = 0
+
+    def identify(self, books):
+        books = [_Book(i, title, authors, identifiers)
+                 for i, (title, authors, identifiers) in enumerate(books)]
+        self.remaining = len(books)
+        try:
+            for book in books:
+                self._start(book)
+            with self.finished:
+                while self.remaining > 0 and not self.abort.is_set():
+                    self.finished.wait(0.5)
+        finally:
+            # After an abort, work still queued must not start downloading.
+            # Outside the lock, cancel runs the done callbacks.
+            with self.lock:
+                futures = [f for stage in self.inflight.values() for f in stage.values()]
+            for future in futures:
+                future.cancel()
+        return [book.results for book in books]
+
+    def _submit(self, stage, key, fn, *args):
+        '''
+        Run fn on the executor, unless the same key was already submitted for
+        the stage in which case its future is shared.
+        '''
+        with self.lock:
+            future = self.inflight[stage].get(key, None)
+            if future is None:
+                future = self.executor.submit(fn, *args)
+                self.inflight[stage][key] = future
+            return future
+
+    def _then(self, future, book, callback):
+        def done(future):
+            if self.abort.is_set() or future.cancelled():
+                return self._finish(book)
+            try:
+                result = future.result()
+            except Exception:
+                self.log.exception('Batch identify failed for: %s' % book.title)
+                return self._finish(book)
+            try:
+                callback(book, result)
+            except Exception:
+                self.log.exception('Batch identify failed for: %s' % book.title)
+                self._finish(book)
+        future.add_done_callback(done)
+
+    def _finish(self, book):
+        with self.finished:
+            if book.finished:
+                return
+            book.finished = True
+            self.remaining -= 1
+            self.finished.notify_all()
+
+    # Stage 1: goodreads id from the identifiers ###############################
+
+    def _start(self, book):
+        if not book.identifiers:
+            return self._resolved(book, None)
+        key = tuple(sorted(book.identifiers.items()))
+        future = self._submit('resolve', key, self._resolve, book.identifiers)
+        self._then(future, book, self._resolved)
+
+    def _resolve(self, identifiers):
+        return self.plugin.get_goodreads_id_from_identifiers(self.log, self.abort,
+                timeout=self.timeout, identifiers=identifiers, settings=self.settings)
+
+    def _resolved(self, book, goodreads_id):
+        if goodreads_id:
+            url = '%s/book/show/%s-aaaa' % (self.plugin.BASE_URL, goodreads_id)
+            return self._fetch_details(book, [url])
+        title = normalize(book.title)
+        query = self.plugin.create_query(self.log, title=title, authors=book.authors)
+        if query is None:
+            self.log.error('Insufficient metadata to construct query for: %s' % book.title)
+            return self._finish(book)
+        key = (query, title, tuple(book.authors or ()))
+        future = self._submit('search', key, self._search, query, title, book.authors)
+        self._then(future, book, self._searched)
+
+    # Stage 2: search page #####################################################
+
+    def _search(self, query, title, authors):
+        root, err = self.plugin._fetch_search_page(self.log, self.abort,
+                self.plugin.browser, query, self.timeout, self.settings)
+        if root is None:
+            return ([], None, [])
+        return self.plugin._find_search_matches(self.log, title, authors, root, self.settings)
+
+    def _searched(self, book, search_result):
+        matches, editions_url, title_tokens = search_result
+        if editions_url is None:
+            return self._fetch_details(book, matches)
+        key = (editions_url, tuple(title_tokens), tuple(matches))
+        future = self._submit('editions', key, self._editions, editions_url, matches, title_tokens)
+        self._then(future, book, self._fetch_details)
+
+    # Stage 3: editions page ###################################################
+
+    def _editions(self, editions_url, matches, title_tokens):
+        matches = list(matches)
+        self.plugin._parse_editions_for_book(self.log, editions_url, matches,
+                self.timeout, title_tokens, self.settings)
+        return matches
+
+    # Stage 4: detail pages ####################################################
+
+    def _fetch_details(self, book, matches):
+        if not matches:
+            return self._finish(book)
+        book.pending_details = len(matches)
+        for relevance, url in enumerate(matches):
+            match = re.search('/show/(\d+)', url)
+            key = match.group(1) if match else url
+            future = self._submit('details', key, self._details, url)
+            self._then(future, book, lambda book, mi, relevance=relevance: self._detailed(book, mi, relevance))
+
+    def _details(self, url):
+        from calibre_plugins.goodreads.worker import Worker
+        result_queue = Queue()
+        Worker(url, result_queue, self.plugin.browser, self.log, 0, self.plugin,
+               timeout=self.timeout, settings=self.settings).run()
+        try:
+            return result_queue.get_nowait()
+        except Empty:
+            return None
+
+    def _detailed(self, book, mi, relevance):
+        if mi is not None:
+            # The Metadata may be shared with other books of the batch
+            mi = mi.deepcopy()
+            mi.source_relevance = relevance
+        with self.lock:
+            if mi is not None:
+                book.results.append(mi)
+            book.pending_details -= 1
+            done = book.pending_details == 0
+        if done:
+            self._finish(book)
@@ -0,0 +1,368 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2011, Grant Drake <grant.drake@gmail.com>, 2016-2020 updates by David Forrester <davidfor@internode.on.net>'
+__docformat__ = 'restructuredtext en'
+
+import os, sys, time
+from threading import Event, Lock
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+from lxml.html import tostring
+
+USAGE = '''\
+Offline benchmarks for the Goodreads source. Run with the plugin installed:
+
+    calibre-debug -e benchmark.py parse <folder> [--repeat N]
+        Time the book page parser over saved book pages, for example the
+        book/ folder of a corpus. legacy_lookups times the whole-tree XPath
+        walks the parse methods used to make (the lookups only), details_page
+        times DetailsPage plus every parse method (details_page_debug is the
+        same with debug logging on), stream_parse times the
+        incremental parse that stops after the sections the plugin uses and
+        structured times loading the JSON embedded in the page.
+
+    calibre-debug -e benchmark.py parse-search <folder> [--repeat N]
+        Time the search results parser over saved search pages.
+
+    calibre-debug -e benchmark.py export <corpus>
+        Record a corpus from the responses in the plugin HTTP cache.
+
+    calibre-debug -e benchmark.py serve <corpus> [--port P] [--latency MS]
+        Serve a corpus on a local port, as a stand-in for goodreads.com.
+
+    calibre-debug -e benchmark.py identify <corpus> [--sizes 1,100,10000]
+            [--lookup goodreads|isbn|search] [--latency MS] [--serial]
+            [--no-keepalive]
+        Identify batches of books from the corpus against the local stand-in
+        server, reporting pages/sec, per stage latency, connection reuse and
+        peak RSS. Books are reused round robin when a batch is bigger than
+        the corpus. --no-keepalive downloads with the calibre browser, one
+        connection per page, as the plugin used to.
+'''
+
+# The lookups the parse methods used to make, one absolute walk of the whole
+# tree per field, kept here as the baseline for the DetailsPage extraction.
+LEGACY_DATA_BOX = '//div[@id="metacol"]/div[@id="details"]/div[@class="buttons"]/div[@id="bookDataBox"]/div'
+LEGACY_XPATHS = (
+    '//div[@id="metacol"]/h1[@id="bookTitle"]',
+    '//div[@id="metacol"]/div[@id="bookAuthors"]',
+    '//div[@id="metacol"]/h2[@id="bookSeries"]/a',
+    '//span[@itemprop="ratingValue"]',
+    '//div[@id="descriptionContainer"]/div[@id="description"]/span',
+    '//div[@class="bookCoverPrimary"]/a/img/@src',
+    '//div[@class="stacked"]/div/div/div[contains(@class, "bigBoxContent")]/div/div[@class="left"]',
+    '//div[@id="metacol"]/div[@id="details"]/div[2]',
+    LEGACY_DATA_BOX + '/div[@itemprop="inLanguage"]',
+    '//span[@itemprop="ratingValue"]',
+    '//*[@itemprop="ratingCount"]/@content',
+)
+
+
+def load_plugin():
+    from calibre.customize.ui import metadata_plugins
+    for plugin in metadata_plugins(['identify']):
+        if plugin.name == 'GoodreadsReviews':
+            return plugin
+    raise SystemExit('The GoodreadsReviews plugin is not installed')
+
+
+def load_pages(folder):
+    pages = []
+    for name in sorted(os.listdir(folder)):
+        if name.lower().endswith(('.html', '.htm')):
+            with open(os.path.join(folder, name), 'rb') as f:
+                pages.append((name, f.read()))
+    return pages
+
+
+class NullBrowser(object):
+
+    def clone_browser(self):
+        return self
+
+
+def quiet_log():
+    from calibre.utils.logging import Log
+    log = Log()
+    log.outputs = []
+    return log
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))]
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    fn(*args)
+    return (time.perf_counter() - start) * 1000
+
+
+def legacy_lookups(root):
+    for xpath in LEGACY_XPATHS:
+        root.xpath(xpath)
+    # parse_isbn and parse_asin each serialised every bookDataBox row
+    for i in range(2):
+        for row in root.xpath(LEGACY_DATA_BOX):
+            tostring(row, method='text', encoding='unicode')
+
+
+def extract_all(worker, root):
+    from calibre_plugins.goodreads.worker import DetailsPage
+    page = DetailsPage(root)
+    for name in ('parse_title', 'parse_authors', 'parse_series', 'parse_isbn',
+                 'parse_asin', 'parse_rating', 'parse_comments', 'parse_cover',
+                 'parse_tags', 'parse_publisher_and_date', '_parse_language',
+                 'parse_rating_withcount'):
+        try:
+            getattr(worker, name)(page)
+        except Exception:
+            # Same as parse_details, a missing field is not an error here
+            pass
+
+
+def report(name, timings):
+    print('%-20s calls=%-6d mean=%8.3fms  p50=%8.3fms  p95=%8.3fms' % (
+        name, len(timings), sum(timings) / max(1, len(timings)),
+        percentile(timings, 50), percentile(timings, 95)))
+
+
+def peak_rss_mb():
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Kilobytes on Linux, bytes on macOS
+        return peak / (1024.0 * 1024.0) if sys.platform == 'darwin' else peak / 1024.0
+    except ImportError:
+        import psutil
+        return psutil.Process().memory_info().peak_wset / (1024.0 * 1024.0)
+
+
+def bench_parse(folder, repeat=5):
+    from calibre_plugins.goodreads.pool import CHUNK_SIZE
+    from calibre_plugins.goodreads.structured import StructuredData
+    from calibre_plugins.goodreads.worker import DebugLog, Worker, parse_html, parse_html_stream
+    plugin = load_plugin()
+    pages = load_pages(folder)
+    if not pages:
+        raise SystemExit('No saved .html pages found in: %s' % folder)
+    worker = Worker('https://www.goodreads.com/book/show/1', Queue(), NullBrowser(),
+                    quiet_log(), 0, plugin)
+    roots = [parse_html(raw) for name, raw in pages]
+    results = {'parse_html': [], 'stream_parse': [], 'legacy_lookups': [], 'details_page': [],
+               'details_page_debug': [], 'structured': []}
+    # The same extraction with debug logging off, the default, and on
+    quiet, verbose = DebugLog(worker.log, False), DebugLog(worker.log, True)
+    read = total = 0
+    for i in range(repeat):
+        for (name, raw), root in zip(pages, roots):
+            results['parse_html'].append(timed(parse_html, raw))
+            chunks = [raw[j:j + CHUNK_SIZE] for j in range(0, len(raw), CHUNK_SIZE)]
+            start = time.perf_counter()
+            scanner = parse_html_stream(chunks)
+            scanner.root()
+            results['stream_parse'].append((time.perf_counter() - start) * 1000)
+            read += scanner.bytes_fed
+            total += len(raw)
+            results['legacy_lookups'].append(timed(legacy_lookups, root))
+            worker.debug = quiet
+            results['details_page'].append(timed(extract_all, worker, root))
+            worker.debug = verbose
+            results['details_page_debug'].append(timed(extract_all, worker, root))
+            results['structured'].append(timed(StructuredData, root))
+    for name in ('parse_html', 'stream_parse', 'legacy_lookups', 'details_page', 'details_page_debug',
+                 'structured'):
+        report(name, results[name])
+    print('stream_parse read %.1f%% of the page bytes' % (100.0 * read / max(1, total)))
+
+
+def bench_parse_search(folder, repeat=5):
+    from lxml.html import fromstring
+    from calibre_plugins.goodreads.config import get_settings
+    from calibre.utils.cleantext import clean_ascii_chars
+    plugin = load_plugin()
+    pages = load_pages(folder)
+    if not pages:
+        raise SystemExit('No saved .html pages found in: %s' % folder)
+    log = quiet_log()
+    settings = get_settings()
+    results = {'parse_html': [], 'search_matches': []}
+    for i in range(repeat):
+        for name, raw in pages:
+            start = time.perf_counter()
+            root = fromstring(clean_ascii_chars(raw.strip().decode('utf-8', errors='replace')))
+            results['parse_html'].append((time.perf_counter() - start) * 1000)
+            # No title or authors so every row of the page is a match
+            results['search_matches'].append(timed(plugin._find_search_matches, log, None, None, root, settings))
+    for name in ('parse_html', 'search_matches'):
+        report(name, results[name])
+
+
+class StageTimer(object):
+
+    '''
+    Times calls of functions replaced on their class or module for the length
+    of a benchmark run
+    '''
+
+    def __init__(self):
+        self.timings = {}
+        self.lock = Lock()
+        self.patched = []
+
+    def add(self, stage, ms):
+        with self.lock:
+            self.timings.setdefault(stage, []).append(ms)
+
+    def wrap(self, owner, name, stage):
+        original = getattr(owner, name)
+        timer = self
+
+        def timed_call(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                timer.add(stage(*args, **kwargs) if callable(stage) else stage,
+                          (time.perf_counter() - start) * 1000)
+        self.patched.append((owner, name, original))
+        setattr(owner, name, timed_call)
+
+    def restore(self):
+        for owner, name, original in reversed(self.patched):
+            setattr(owner, name, original)
+        self.patched = []
+
+
+def books_for_lookup(books, lookup):
+    ans = []
+    for book in books:
+        identifiers = book['identifiers']
+        if lookup == 'goodreads':
+            identifiers = {'goodreads': identifiers['goodreads']}
+        elif lookup == 'isbn':
+            identifiers = {'isbn': identifiers['isbn']} if 'isbn' in identifiers else {}
+        else:
+            identifiers = {}
+        ans.append((book['title'], book['authors'], identifiers))
+    return ans
+
+
+def bench_identify(folder, sizes, lookup='goodreads', latency=0, serial=False,
+                   keepalive=True):
+    import calibre_plugins.goodreads.covers as covers
+    import calibre_plugins.goodreads.editions as editions
+    import calibre_plugins.goodreads.fetcher as fetcher
+    import calibre_plugins.goodreads.idindex as idindex
+    import calibre_plugins.goodreads.worker as worker
+    from calibre_plugins.goodreads.cache import HttpCache, page_type_for_url
+    from calibre_plugins.goodreads.corpus import ReplayServer, load_books
+    from calibre_plugins.goodreads.pool import BrowserTransport, PooledTransport
+    from calibre_plugins.goodreads.throttle import HostRateController
+
+    books = books_for_lookup(load_books(folder), lookup)
+    if not books:
+        raise SystemExit('No books in the corpus: %s' % folder)
+    server = ReplayServer(folder, latency=latency / 1000.0).start()
+    plugin = load_plugin()
+    plugin_class = type(plugin)
+    base_url = plugin_class.BASE_URL
+    plugin_class.BASE_URL = server.base_url
+    # Nothing may come from the persistent stores of a real calibre install:
+    # the cache keeps nothing and the pacing is left to the server latency
+    transport = PooledTransport() if keepalive else BrowserTransport()
+    fetcher._fetcher = fetcher.Fetcher(HttpCache(path=':memory:', max_size=0),
+                                       HostRateController(rate=1000000, capacity=1000000),
+                                       transport=transport)
+    timer = StageTimer()
+    timer.wrap(fetcher.Fetcher, 'fetch',
+               lambda self, browser, url, *args, **kwargs: 'fetch:' + page_type_for_url(url))
+    timer.wrap(worker, 'parse_html', 'parse_html')
+    timer.wrap(worker.Worker, 'parse_details', 'parse_details')
+    timer.wrap(plugin_class, '_find_search_matches', 'search_matches')
+    log = quiet_log()
+    try:
+        for size in sizes:
+            idindex._index = idindex.IdentifierIndex(path=':memory:')
+            editions._editions_cache = editions.EditionsCache(path=':memory:')
+            covers._store = covers.CoverStore(path=':memory:')
+            batch = [books[i % len(books)] for i in range(size)]
+            timer.timings = {}
+            served = server.requests_served
+            start = time.perf_counter()
+            if serial:
+                for title, authors, identifiers in batch:
+                    plugin.identify(log, Queue(), Event(), title=title, authors=authors,
+                                    identifiers=identifiers)
+            else:
+                plugin.identify_batch(log, batch, Event())
+            elapsed = time.perf_counter() - start
+            pages = server.requests_served - served
+            print('books=%-6d elapsed=%8.2fs  pages=%-6d pages/sec=%8.1f  peak_rss=%8.1fMB' % (
+                size, elapsed, pages, pages / max(elapsed, 1e-9), peak_rss_mb()))
+            for stage in sorted(timer.timings):
+                report('  ' + stage, timer.timings[stage])
+            if keepalive:
+                print('  connections: %(connections_created)d created, %(connections_reused)d reused,'
+                      ' %(stale_retries)d stale' % transport.pool.metrics)
+    finally:
+        timer.restore()
+        plugin_class.BASE_URL = base_url
+        fetcher._fetcher = None
+        idindex._index = None
+        editions._editions_cache = None
+        covers._store = None
+        server.stop()
+
+
+def serve(folder, port=0, latency=0):
+    from calibre_plugins.goodreads.corpus import ReplayServer
+    server = ReplayServer(folder, port=port, latency=latency / 1000.0)
+    print('Serving %s on %s' % (folder, server.base_url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+def main(args):
+    import argparse
+    parser = argparse.ArgumentParser(prog='benchmark.py', usage=USAGE)
+    parser.add_argument('command', choices=('parse', 'parse-search', 'export', 'serve', 'identify'))
+    parser.add_argument('folder')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--port', type=int, default=0)
+    parser.add_argument('--latency', type=float, default=0, help='milliseconds')
+    parser.add_argument('--sizes', default='1,100,10000')
+    parser.add_argument('--lookup', choices=('goodreads', 'isbn', 'search'), default='goodreads')
+    parser.add_argument('--serial', action='store_true', help='identify one book at a time')
+    parser.add_argument('--no-keepalive', dest='keepalive', action='store_false')
+    opts = parser.parse_args(args)
+    if opts.command == 'parse':
+        bench_parse(opts.folder, opts.repeat)
+    elif opts.command == 'parse-search':
+        bench_parse_search(opts.folder, opts.repeat)
+    elif opts.command == 'export':
+        from calibre_plugins.goodreads.corpus import export_corpus
+        from calibre_plugins.goodreads.fetcher import get_fetcher
+        export_corpus(get_fetcher().cache, opts.folder)
+    elif opts.command == 'serve':
+        serve(opts.folder, opts.port, opts.latency)
+    else:
+        bench_identify(opts.folder, [int(x) for x in opts.sizes.split(',')],
+                       lookup=opts.lookup, latency=opts.latency, serial=opts.serial,
+                       keepalive=opts.keepalive)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
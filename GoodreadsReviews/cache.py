@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2011, Grant Drake <grant.drake@gmail.com>, 2016-2020 updates by David Forrester <davidfor@internode.on.net>'
+__docformat__ = 'restructuredtext en'
+
+import time, zlib
+from collections import namedtuple
+
+from calibre_plugins.goodreads.storage import SQLiteStore
+
+DAY = 24 * 60 * 60
+
+# How long a cached page is used without asking Goodreads at all. Once a page
+# is older than this it is revalidated using its ETag/Last-Modified headers.
+PAGE_TTLS = {
+    'book': 7 * DAY,
+    'editions': 7 * DAY,
+    'search': 1 * DAY,
+    'autocomplete': 30 * DAY,
+    'other': 1 * DAY,
+}
+
+MAX_CACHE_SIZE = 256 * 1024 * 1024
+
+# complete is False for a body cut short because the reader had what it needed,
+# see Fetcher.fetch
+CachedResponse = namedtuple('CachedResponse', 'url page_type body etag last_modified fetched complete')
+
+
+def page_type_for_url(url):
+    if '/book/auto_complete' in url:
+        return 'autocomplete'
+    if '/work/editions/' in url:
+        return 'editions'
+    if '/search?' in url:
+        return 'search'
+    if '/book/show/' in url:
+        return 'book'
+    return 'other'
+
+
+class HttpCache(SQLiteStore):
+
+    '''
+    Persistent cache of Goodreads responses keyed by URL. Bodies are stored
+    compressed and the least recently used entries are evicted once the total
+    size goes over max_size.
+    '''
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS responses (
+            url TEXT PRIMARY KEY,
+            page_type TEXT NOT NULL,
+            body BLOB NOT NULL,
+            size INTEGER NOT NULL,
+            etag TEXT,
+            last_modified TEXT,
+            fetched REAL NOT NULL,
+            accessed REAL NOT NULL,
+            complete INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed);
+    '''
+
+    def __init__(self, path=None, max_size=MAX_CACHE_SIZE):
+        SQLiteStore.__init__(self, 'http_cache', path=path)
+        self.max_size = max_size
+        self._upgrade()
+        self.total_size = self._current_size()
+
+    def _upgrade(self):
+        # Caches written by older versions did not record whether a body was
+        # complete, they default to not, so they are only used for streamed reads
+        columns = [row[1] for row in self.execute('PRAGMA table_info(responses)')]
+        if 'complete' not in columns:
+            self.execute('ALTER TABLE responses ADD COLUMN complete INTEGER NOT NULL DEFAULT 0')
+
+    def _current_size(self):
+        return self.execute('SELECT COALESCE(SUM(size), 0) FROM responses')[0][0]
+
+    def get(self, url):
+        rows = self.execute('SELECT page_type, body, etag, last_modified, fetched, complete'
+                            ' FROM responses WHERE url=?', (url,))
+        if not rows:
+            return None
+        page_type, body, etag, last_modified, fetched, complete = rows[0]
+        self.execute('UPDATE responses SET accessed=? WHERE url=?', (time.time(), url))
+        return CachedResponse(url, page_type, zlib.decompress(body), etag, last_modified, fetched,
+                              bool(complete))
+
+    def is_fresh(self, cached, now=None):
+        now = time.time() if now is None else now
+        ttl = PAGE_TTLS.get(cached.page_type, PAGE_TTLS['other'])
+        return now - cached.fetched < ttl
+
+    def put(self, url, page_type, body, etag=None, last_modified=None, complete=True):
+        data = zlib.compress(body)
+        now = time.time()
+        with self.lock:
+            # A refreshed page replaces its old entry, which no longer counts
+            replaced = self.execute('SELECT size FROM responses WHERE url=?', (url,))
+            self.execute('INSERT OR REPLACE INTO responses'
+                         ' (url, page_type, body, size, etag, last_modified, fetched, accessed,'
+                         ' complete) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                         (url, page_type, data, len(data), etag, last_modified, now, now,
+                          1 if complete else 0))
+            self.total_size += len(data) - (replaced[0][0] if replaced else 0)
+            if self.total_size > self.max_size:
+                self.evict()
+
+    def entries(self, page_type=None):
+        '''
+        Every cached response, optionally only those of one page type
+        '''
+        sql = 'SELECT url, page_type, body, etag, last_modified, fetched, complete FROM responses'
+        args = ()
+        if page_type is not None:
+            sql += ' WHERE page_type=?'
+            args = (page_type,)
+        for url, page_type, body, etag, last_modified, fetched, complete in self.execute(sql, args):
+            yield CachedResponse(url, page_type, zlib.decompress(body), etag, last_modified, fetched,
+                                 bool(complete))
+
+    def refresh(self, url):
+        '''
+        Mark a cached entry as fresh again after a 304 Not Modified response
+        '''
+        now = time.time()
+        self.execute('UPDATE responses SET fetched=?, accessed=? WHERE url=?', (now, now, url))
+
+    def evict(self):
+        # Other processes may have written to the same file so start from the
+        # real size, then drop the least recently used entries until we are
+        # comfortably below the limit.
+        with self.lock:
+            self.total_size = self._current_size()
+            target = int(self.max_size * 0.9)
+            if self.total_size <= target:
+                return
+            rows = self.execute('SELECT url, size FROM responses ORDER BY accessed')
+            doomed = []
+            for url, size in rows:
+                if self.total_size <= target:
+                    break
+                doomed.append((url,))
+                self.total_size -= size
+            self.executemany('DELETE FROM responses WHERE url=?', doomed)
+
+    def clear(self):
+        with self.lock:
+            self.execute('DELETE FROM responses')
+            self.total_size = 0
@@ -8,6 +8,7 @@ __copyright__ = '2011, Grant Drake <grant.drake@gmail.com>, 2016-2020 updates by
 __docformat__ = 'restructuredtext en'
 
 import copy
+from collections import namedtuple
 from functools import partial
 
 from six import text_type as unicode
@@ -15,12 +16,12 @@ from six import text_type as unicode
 try:
     from PyQt5.Qt import (QTableWidgetItem, QVBoxLayout, Qt, QGroupBox, QTableWidget,
                           QCheckBox, QAbstractItemView, QHBoxLayout, QIcon,
-                          QInputDialog, QToolButton, QSpacerItem)
+                          QInputDialog, QToolButton, QSpacerItem, QLabel, QSpinBox)
     from PyQt5.QtWidgets import QSizePolicy
 except ImportError:
     from PyQt4.Qt import (QTableWidgetItem, QVBoxLayout, Qt, QGroupBox, QTableWidget,
                           QCheckBox, QAbstractItemView, QHBoxLayout, QIcon,
-                          QInputDialog, QToolButton, QSpacerItem)
+                          QInputDialog, QToolButton, QSpacerItem, QLabel, QSpinBox)
     from PyQt4.QtGui import QSizePolicy
 
 # Maintain backwards compatibility with older versions of Qt and calibre.
@@ -43,6 +44,10 @@ KEY_GET_ALL_AUTHORS = 'getAllAuthors'
 KEY_GET_EDITIONS = 'getEditions'
 KEY_GET_ASIN = 'getAsin'
 KEY_GENRE_MAPPINGS = 'genreMappings'
+KEY_MAX_DOWNLOADS = 'maxConcurrentDownloads'
+KEY_MAX_CANDIDATES = 'maxCandidates'
+KEY_COLLECT_TIMINGS = 'collectTimings'
+KEY_DEBUG_LOGGING = 'debugLogging'
 
 DEFAULT_GENRE_MAPPINGS = {
                 'Anthologies': ['Anthologies'],
@@ -108,6 +113,10 @@ DEFAULT_STORE_VALUES = {
     KEY_GET_EDITIONS: False,
     KEY_GET_ALL_AUTHORS: False,
     KEY_GET_ASIN: False,
+    KEY_MAX_DOWNLOADS: 4,
+    KEY_MAX_CANDIDATES: 3,
+    KEY_COLLECT_TIMINGS: False,
+    KEY_DEBUG_LOGGING: False,
     KEY_GENRE_MAPPINGS: copy.deepcopy(DEFAULT_GENRE_MAPPINGS)
 }
 
@@ -122,6 +131,28 @@ def get_plugin_pref(store_name, option):
     default_value = plugin_prefs.defaults[store_name][option]
     return c.get(option, default_value)
 
+# The options as used by one identify run, see get_settings
+Settings = namedtuple('Settings', 'get_editions get_all_authors get_asin max_downloads '
+                      'max_candidates collect_timings debug_logging genre_mapper')
+
+def get_settings():
+    '''
+    Snapshot of the options, taken once at the start of identify and passed
+    down to the Workers. Options saved while a run is going only apply to
+    the next one, and the books of a run never read the JSON config.
+    '''
+    from calibre_plugins.goodreads.genres import get_genre_mapper
+    c = get_plugin_prefs(STORE_NAME, fill_defaults=True)
+    return Settings(
+        get_editions=bool(c[KEY_GET_EDITIONS]),
+        get_all_authors=bool(c[KEY_GET_ALL_AUTHORS]),
+        get_asin=bool(c[KEY_GET_ASIN]),
+        max_downloads=int(c[KEY_MAX_DOWNLOADS]),
+        max_candidates=int(c[KEY_MAX_CANDIDATES]),
+        collect_timings=bool(c[KEY_COLLECT_TIMINGS]),
+        debug_logging=bool(c[KEY_DEBUG_LOGGING]),
+        genre_mapper=get_genre_mapper(c[KEY_GENRE_MAPPINGS]))
+
 def get_plugin_prefs(store_name, fill_defaults=False):
     if fill_defaults:
         c = get_prefs(plugin_prefs, store_name)
@@ -296,6 +327,48 @@ class ConfigWidget(DefaultConfigWidget):
         self.get_asin_checkbox.setChecked(c[KEY_GET_ASIN])
         other_group_box_layout.addWidget(self.get_asin_checkbox)
 
+        max_downloads_layout = QHBoxLayout()
+        other_group_box_layout.addLayout(max_downloads_layout)
+        max_downloads_label = QLabel('Maximum simultaneous downloads:', self)
+        max_downloads_label.setToolTip('The number of Goodreads book pages downloaded at the same time,\n'
+                                       'shared by all books being identified. Higher values are faster\n'
+                                       'but more likely to be throttled by Goodreads.')
+        max_downloads_layout.addWidget(max_downloads_label)
+        self.max_downloads_spin = QSpinBox(self)
+        self.max_downloads_spin.setRange(1, 16)
+        self.max_downloads_spin.setValue(c[KEY_MAX_DOWNLOADS])
+        max_downloads_label.setBuddy(self.max_downloads_spin)
+        max_downloads_layout.addWidget(self.max_downloads_spin)
+        max_downloads_layout.addStretch(1)
+
+        max_candidates_layout = QHBoxLayout()
+        other_group_box_layout.addLayout(max_candidates_layout)
+        max_candidates_label = QLabel('Maximum search results to download:', self)
+        max_candidates_label.setToolTip('For title/author searches, the search results are scored on how well the\n'
+                                        'title and authors match and how many ratings the book has. Only the\n'
+                                        'book pages of this many of the best results are downloaded.')
+        max_candidates_layout.addWidget(max_candidates_label)
+        self.max_candidates_spin = QSpinBox(self)
+        self.max_candidates_spin.setRange(1, 20)
+        self.max_candidates_spin.setValue(c[KEY_MAX_CANDIDATES])
+        max_candidates_label.setBuddy(self.max_candidates_spin)
+        max_candidates_layout.addWidget(self.max_candidates_spin)
+        max_candidates_layout.addStretch(1)
+
+        self.collect_timings_checkbox = QCheckBox('Log timings of each download (for troubleshooting slow downloads)', self)
+        self.collect_timings_checkbox.setToolTip('When this option is checked, the time spent downloading and parsing\n'
+                                                 'Goodreads pages is added up for each metadata download, shown at the\n'
+                                                 'end of the log and saved as JSON in the plugin cache folder.')
+        self.collect_timings_checkbox.setChecked(c[KEY_COLLECT_TIMINGS])
+        other_group_box_layout.addWidget(self.collect_timings_checkbox)
+
+        self.debug_logging_checkbox = QCheckBox('Detailed debug logging of book page parsing', self)
+        self.debug_logging_checkbox.setToolTip('When this option is checked, how each field is read from the Goodreads\n'
+                                               'book page is written to the log. Leave it off for bulk downloads,\n'
+                                               'it slows them down.')
+        self.debug_logging_checkbox.setChecked(c[KEY_DEBUG_LOGGING])
+        other_group_box_layout.addWidget(self.debug_logging_checkbox)
+
         self.edit_table.populate_table(c[KEY_GENRE_MAPPINGS])
 
     def commit(self):
@@ -304,12 +377,19 @@ class ConfigWidget(DefaultConfigWidget):
         new_prefs[KEY_GET_EDITIONS] = self.get_editions_checkbox.checkState() == Qt.Checked
         new_prefs[KEY_GET_ALL_AUTHORS] = self.all_authors_checkbox.checkState() == Qt.Checked
         new_prefs[KEY_GET_ASIN] = self.get_asin_checkbox.checkState() == Qt.Checked
+        new_prefs[KEY_MAX_DOWNLOADS] = self.max_downloads_spin.value()
+        new_prefs[KEY_MAX_CANDIDATES] = self.max_candidates_spin.value()
+        new_prefs[KEY_COLLECT_TIMINGS] = self.collect_timings_checkbox.checkState() == Qt.Checked
+        new_prefs[KEY_DEBUG_LOGGING] = self.debug_logging_checkbox.checkState() == Qt.Checked
         new_prefs[KEY_GENRE_MAPPINGS] = self.edit_table.get_data()
         plugin_prefs[STORE_NAME] = new_prefs
+        from calibre_plugins.goodreads.genres import invalidate_genre_mapper
+        invalidate_genre_mapper()
 
     def add_mapping(self):
         new_genre_name, ok = QInputDialog.getText(self, 'Add new mapping',
-                    'Enter a Goodreads genre name to create a mapping for:', text='')
+                    'Enter a Goodreads genre name to create a mapping for\n'
+                    '(end it with " > *" to map every genre under it):', text='')
         if not ok:
             # Operation cancelled
             return
@@ -340,7 +420,8 @@ class ConfigWidget(DefaultConfigWidget):
         if not selected_genre:
             return
         new_genre_name, ok = QInputDialog.getText(self, 'Add new mapping',
-                    'Enter a Goodreads genre name to create a mapping for:', text=selected_genre)
+                    'Enter a Goodreads genre name to create a mapping for\n'
+                    '(end it with " > *" to map every genre under it):', text=selected_genre)
         if not ok:
             # Operation cancelled
             return
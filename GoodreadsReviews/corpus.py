@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2011, Grant Drake <grant.drake@gmail.com>, 2016-2020 updates by David Forrester <davidfor@internode.on.net>'
+__docformat__ = 'restructuredtext en'
+
+# A corpus is a folder of recorded Goodreads responses, used to benchmark the
+# plugin without touching goodreads.com:
+#
+#   index.json      URL path and query -> recorded response
+#   books.json      title, authors and identifiers of every recorded book page
+#   book/, search/, editions/, autocomplete/
+#                   the response bodies, one file per URL
+
+import hashlib, io, json, os, re, time
+from threading import Lock, Thread
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlsplit
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlsplit
+
+CONTENT_TYPES = {
+    'autocomplete': 'application/json; charset=utf-8',
+}
+
+
+def url_key(url):
+    '''
+    Responses are keyed without scheme and host so they can be replayed from
+    any server address
+    '''
+    parts = urlsplit(url)
+    return parts.path + ('?' + parts.query if parts.query else '')
+
+
+def export_corpus(cache, folder, log=print):
+    '''
+    Write every response in the HttpCache to a corpus folder. Run a normal
+    identify over the books of interest first so they are in the cache.
+    Book pages whose download identify stopped early are left out, they
+    would have the benchmarks parse part of a page.
+    '''
+    index = {}
+    books = []
+    partial = 0
+    for entry in cache.entries():
+        if not entry.complete:
+            partial += 1
+            continue
+        name = hashlib.sha1(entry.url.encode('utf-8')).hexdigest()
+        ext = '.json' if entry.page_type == 'autocomplete' else '.html'
+        relpath = entry.page_type + '/' + name + ext
+        path = os.path.join(folder, entry.page_type)
+        if not os.path.exists(path):
+            os.makedirs(path)
+        with open(os.path.join(folder, relpath), 'wb') as f:
+            f.write(entry.body)
+        index[url_key(entry.url)] = {'file': relpath, 'page_type': entry.page_type,
+                                     'etag': entry.etag, 'last_modified': entry.last_modified}
+        if entry.page_type == 'book':
+            book = book_from_page(entry.url, entry.body)
+            if book is not None:
+                books.append(book)
+    with io.open(os.path.join(folder, 'index.json'), 'w', encoding='utf-8') as f:
+        f.write(json.dumps(index, indent=1, ensure_ascii=False))
+    with io.open(os.path.join(folder, 'books.json'), 'w', encoding='utf-8') as f:
+        f.write(json.dumps(books, indent=1, ensure_ascii=False))
+    log('Exported %d responses and %d books to: %s' % (len(index), len(books), folder))
+    if partial:
+        log('Left out %d partly downloaded responses' % partial)
+    return len(index)
+
+
+def book_from_page(url, raw):
+    from calibre_plugins.goodreads.worker import (DetailsPage, XPATH_AUTHORS,
+            XPATH_TITLE, node_text, parse_html)
+    match = re.search('/show/(\d+)', url)
+    if match is None:
+        return None
+    page = DetailsPage(parse_html(raw))
+    title = page.metacol_xpath(XPATH_TITLE)
+    authors = page.metacol_xpath(XPATH_AUTHORS)
+    if not title:
+        return None
+    identifiers = {'goodreads': match.group(1)}
+    for row_text, cells, cell_texts in page.data_rows:
+        if cell_texts and cell_texts[0] in ('ISBN', 'ISBN13') and len(cell_texts) > 1:
+            identifiers['isbn'] = cell_texts[1].split()[0]
+    authors = node_text(authors[0]) if authors else ''
+    if authors.startswith('by'):
+        authors = authors[2:]
+    return {'title': node_text(title[0]),
+            'authors': [a.split('(')[0].strip() for a in authors.split(',') if a.strip()],
+            'identifiers': identifiers}
+
+
+def load_books(folder):
+    with io.open(os.path.join(folder, 'books.json'), encoding='utf-8') as f:
+        return json.loads(f.read())
+
+
+class ReplayServer(ThreadingMixIn, HTTPServer):
+
+    '''
+    Local stand-in for www.goodreads.com serving the responses of a corpus.
+    latency (in seconds) is added to every response to mimic the network.
+    Unknown URLs get a 404, like a book Goodreads does not have.
+    '''
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, folder, port=0, latency=0):
+        with io.open(os.path.join(folder, 'index.json'), encoding='utf-8') as f:
+            self.index = json.loads(f.read())
+        self.folder = folder
+        self.latency = latency
+        # identify asks for /book/show/<id>-aaaa while the recorded page may
+        # have been found through a search, so book pages also match by id
+        self.books_by_id = {}
+        for key, entry in self.index.items():
+            match = re.match('/book/show/(\d+)', key)
+            if match is not None:
+                self.books_by_id[match.group(1)] = entry
+        self.requests_served = 0
+        self.bytes_served = 0
+        self.counter_lock = Lock()
+        HTTPServer.__init__(self, ('127.0.0.1', port), ReplayHandler)
+
+    @property
+    def base_url(self):
+        return 'http://127.0.0.1:%d' % self.server_address[1]
+
+    def start(self):
+        t = Thread(target=self.serve_forever, name='GoodreadsReplayServer')
+        t.daemon = True
+        t.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class ReplayHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+        entry = server.index.get(self.path, None)
+        if entry is None:
+            match = re.match('/book/show/(\d+)', self.path)
+            if match is not None:
+                entry = server.books_by_id.get(match.group(1), None)
+        if entry is None:
+            return self._send(404, b'<html><head><title>404 - Page not found</title></head></html>',
+                              'text/html; charset=utf-8')
+        etag = entry.get('etag', None)
+        if etag and self.headers.get('If-None-Match', None) == etag:
+            return self._send(304, b'', None, etag=etag)
+        with open(os.path.join(server.folder, entry['file']), 'rb') as f:
+            body = f.read()
+        self._send(200, body, CONTENT_TYPES.get(entry['page_type'], 'text/html; charset=utf-8'),
+                   etag=etag, last_modified=entry.get('last_modified', None))
+
+    def _send(self, code, body, content_type, etag=None, last_modified=None):
+        self.send_response(code)
+        if content_type:
+            self.send_header('Content-Type', content_type)
+        if etag:
+            self.send_header('ETag', etag)
+        if last_modified:
+            self.send_header('Last-Modified', last_modified)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        with self.server.counter_lock:
+            self.server.requests_served += 1
+            self.server.bytes_served += len(body)
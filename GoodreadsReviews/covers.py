@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2011, Grant Drake <grant.drake@gmail.com>, 2016-2020 updates by David Forrester <davidfor@internode.on.net>'
+__docformat__ = 'restructuredtext en'
+
+import hashlib, os, re, time
+from threading import Lock, current_thread
+
+from calibre_plugins.goodreads.storage import SQLiteStore
+
+COVER_FOLDER = 'covers'
+MAX_COVER_CACHE_SIZE = 512 * 1024 * 1024
+# os.rename does not replace an existing file on Windows, os.replace does (Python 3)
+replace_file = getattr(os, 'replace', os.rename)
+
+# Books without a cover link to a "nophoto" placeholder
+NO_COVER = re.compile(r'/nophoto/')
+# Resized covers: ".../12345._SX98_.jpg", ".../12345._SY475_.jpg", "._SX50_SY75_"
+SIZE_SUFFIX = re.compile(r'\._S[XY]\d+_(?:S[XY]\d+_)?(?=\.\w+$)')
+# Older covers come in s(mall), m(edium) and l(arge): ".../books/1388212715m/1.jpg"
+SIZE_FOLDER = re.compile(r'(/books/\d+)[sm](/)')
+
+
+def cover_url_candidates(url):
+    '''
+    URLs for the cover at url, largest size first. Empty for the placeholder
+    of books without a cover.
+    '''
+    if not url or NO_COVER.search(url):
+        return []
+    full = SIZE_SUFFIX.sub('', url)
+    large = SIZE_FOLDER.sub(r'\1l\2', full)
+    candidates = []
+    for candidate in (large, full, url):
+        if candidate not in candidates:
+            candidates.append(candidate)
+    return candidates
+
+
+class CoverStore(SQLiteStore):
+
+    '''
+    Persistent Goodreads id to cover URL map, and the downloaded covers. The
+    bytes are stored once per content in a folder named by their SHA1, so
+    size variants of the same image or books sharing a cover take no extra
+    space. The least recently used covers are dropped once the folder goes
+    over max_size.
+    '''
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS cover_urls (
+            goodreads_id TEXT PRIMARY KEY,
+            url TEXT NOT NULL,
+            updated REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS cover_files (
+            url TEXT PRIMARY KEY,
+            digest TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            accessed REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS cover_files_digest ON cover_files (digest);
+    '''
+
+    def __init__(self, path=None, folder=None, max_size=MAX_COVER_CACHE_SIZE):
+        SQLiteStore.__init__(self, 'covers', path=path)
+        if folder is None and self.path != ':memory:':
+            folder = os.path.join(os.path.dirname(self.path), COVER_FOLDER)
+        self.folder = folder
+        self.max_size = max_size
+        self.total_size = self._current_size()
+
+    def _current_size(self):
+        # Each content is stored once, whatever the number of URLs for it
+        return self.execute('SELECT COALESCE(SUM(size), 0) FROM'
+                            ' (SELECT MAX(size) AS size FROM cover_files GROUP BY digest)')[0][0]
+
+    def url_for_id(self, goodreads_id):
+        rows = self.execute('SELECT url FROM cover_urls WHERE goodreads_id=?', (goodreads_id,))
+        return rows[0][0] if rows else None
+
+    def record_url(self, goodreads_id, url):
+        self.execute('INSERT OR REPLACE INTO cover_urls (goodreads_id, url, updated) VALUES (?, ?, ?)',
+                     (goodreads_id, url, time.time()))
+
+    def _file(self, digest):
+        return os.path.join(self.folder, digest[:2], digest)
+
+    def get_bytes(self, url):
+        if self.folder is None:
+            return None
+        rows = self.execute('SELECT digest FROM cover_files WHERE url=?', (url,))
+        if not rows:
+            return None
+        try:
+            with open(self._file(rows[0][0]), 'rb') as f:
+                data = f.read()
+        except EnvironmentError:
+            # Deleted behind our back, forget about it
+            self.execute('DELETE FROM cover_files WHERE url=?', (url,))
+            return None
+        self.execute('UPDATE cover_files SET accessed=? WHERE url=?', (time.time(), url))
+        return data
+
+    def put_bytes(self, url, data):
+        if self.folder is None:
+            return
+        digest = hashlib.sha1(data).hexdigest()
+        path = self._file(digest)
+        try:
+            if not os.path.exists(path):
+                if not os.path.exists(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                # Written under a temporary name so other processes never see half a cover
+                tmp = '%s.%d.%d.tmp' % (path, os.getpid(), current_thread().ident)
+                with open(tmp, 'wb') as f:
+                    f.write(data)
+                try:
+                    replace_file(tmp, path)
+                except EnvironmentError:
+                    try:
+                        os.remove(tmp)
+                    except EnvironmentError:
+                        pass
+                    # Fine if another thread or process stored the same cover meanwhile
+                    if not os.path.exists(path):
+                        return
+        except EnvironmentError:
+            return
+        with self.lock:
+            stored = self.execute('SELECT 1 FROM cover_files WHERE digest=? LIMIT 1', (digest,))
+            self.execute('INSERT OR REPLACE INTO cover_files (url, digest, size, accessed)'
+                         ' VALUES (?, ?, ?, ?)', (url, digest, len(data), time.time()))
+            if not stored:
+                self.total_size += len(data)
+            if self.total_size > self.max_size:
+                self.evict()
+
+    def evict(self):
+        # Like HttpCache.evict, starts from the real size as other processes
+        # share the store
+        with self.lock:
+            rows = self.execute('SELECT digest, MAX(size), MAX(accessed) FROM cover_files'
+                                ' GROUP BY digest ORDER BY MAX(accessed)')
+            self.total_size = sum(size for digest, size, accessed in rows)
+            if self.total_size <= self.max_size:
+                return
+            target = int(self.max_size * 0.9)
+            doomed = []
+            for digest, size, accessed in rows:
+                if self.total_size <= target:
+                    break
+                doomed.append((digest,))
+                self.total_size -= size
+            self.executemany('DELETE FROM cover_files WHERE digest=?', doomed)
+        for digest, in doomed:
+            try:
+                os.remove(self._file(digest))
+            except EnvironmentError:
+                pass
+
+
+def download_cover(browser, url, log, min_size, abort=None, timeout=30):
+    '''
+    The bytes of the largest valid size of the cover at url, from the cover
+    store when possible. Images of min_size bytes or less are broken links,
+    see Goodreads.MIN_COVER_SIZE. Returns None if there is no valid cover.
+    '''
+    from calibre_plugins.goodreads.fetcher import FetchAborted, get_fetcher
+    store = get_cover_store()
+    candidates = cover_url_candidates(url)
+    for candidate in candidates:
+        data = store.get_bytes(candidate)
+        if data is not None:
+            log.info('Using cached cover: %s' % candidate)
+            return data
+    for candidate in candidates:
+        log('Downloading cover from:', candidate)
+        try:
+            data = get_fetcher().fetch_uncached(browser, candidate, timeout=timeout,
+                                                log=log, abort=abort)
+        except FetchAborted:
+            return None
+        except Exception:
+            log.exception('Failed to download cover from:', candidate)
+            continue
+        if len(data) > min_size:
+            store.put_bytes(candidate, data)
+            if candidate != url:
+                # Next time the original URL is found without trying the others
+                store.put_bytes(url, data)
+            return data
+        log.warning('Broken image for url: %s' % candidate)
+    return None
+
+
+_store = None
+_store_lock = Lock()
+
+
+def get_cover_store():
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = CoverStore()
+        return _store
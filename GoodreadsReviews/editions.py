@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2011, Grant Drake <grant.drake@gmail.com>, 2016-2020 updates by David Forrester <davidfor@internode.on.net>'
+__docformat__ = 'restructuredtext en'
+
+import json, re, time
+from collections import namedtuple
+from threading import Lock
+from six import text_type as unicode
+
+from lxml import etree
+
+from calibre_plugins.goodreads.cache import PAGE_TTLS
+from calibre_plugins.goodreads.storage import SQLiteStore
+
+# A work is scanned again once its editions are older than this, the same
+# cycle as the editions pages in the HttpCache
+EDITIONS_TTL = PAGE_TTLS['editions']
+
+Edition = namedtuple('Edition', 'title format url language')
+
+XPATH_EDITIONS = etree.XPath('//div[@class="editionData"]')
+XPATH_EDITION_LINK = etree.XPath('./div[1]/a[@class="bookTitle"]')
+XPATH_EDITION_ROWS = etree.XPath('./div[@class="dataRow"]')
+XPATH_EDITION_LANGUAGE = etree.XPath(
+    './/div[@class="dataRow"][div[@class="dataTitle"][starts-with(normalize-space(), "Edition language")]]'
+    '/div[@class="dataValue"]')
+
+
+def work_id_for_url(url):
+    match = re.search(r'/work/editions/(\d+)', url or '')
+    return match.group(1) if match is not None else None
+
+
+def parse_editions_page(root):
+    '''
+    Every edition listed on a /work/editions/ page, in page order. URLs are
+    relative to the Goodreads site.
+    '''
+    editions = []
+    for data in XPATH_EDITIONS(root):
+        link = XPATH_EDITION_LINK(data)
+        if not link or not link[0].get('href'):
+            continue
+        title = (link[0].text or '').strip()
+        # The rows under the title are the publication line, then "Format, N pages"
+        rows = XPATH_EDITION_ROWS(data)
+        book_format = None
+        if len(rows) > 2:
+            book_format = etree.tostring(rows[2], method='text', encoding=unicode).strip().partition(',')[0].strip()
+        language = XPATH_EDITION_LANGUAGE(data)
+        language = etree.tostring(language[0], method='text', encoding=unicode).strip() if language else None
+        editions.append(Edition(title, book_format or None, link[0].get('href'), language or None))
+    return editions
+
+
+class EditionsCache(SQLiteStore):
+
+    '''
+    Persistent Goodreads work id to the editions parsed from its editions
+    page, so a work shared by several books (a series, an omnibus or
+    duplicates in the library) is only fetched and parsed once per
+    EDITIONS_TTL.
+    '''
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS editions (
+            work_id TEXT PRIMARY KEY,
+            editions TEXT NOT NULL,
+            fetched REAL NOT NULL
+        );
+    '''
+
+    def __init__(self, path=None, ttl=EDITIONS_TTL):
+        SQLiteStore.__init__(self, 'editions', path=path)
+        self.ttl = ttl
+
+    def get(self, work_id):
+        '''
+        The list of Editions of the work, or None if not cached or expired
+        '''
+        rows = self.execute('SELECT editions, fetched FROM editions WHERE work_id=?', (work_id,))
+        if not rows or time.time() - rows[0][1] >= self.ttl:
+            return None
+        return [Edition(*e) for e in json.loads(rows[0][0])]
+
+    def put(self, work_id, editions):
+        self.execute('INSERT OR REPLACE INTO editions (work_id, editions, fetched) VALUES (?, ?, ?)',
+                     (work_id, json.dumps([list(e) for e in editions]), time.time()))
+
+    def clear(self):
+        self.execute('DELETE FROM editions')
+
+
+_editions_cache = None
+_editions_cache_lock = Lock()
+
+
+def get_editions_cache():
+    global _editions_cache
+    with _editions_cache_lock:
+        if _editions_cache is None:
+            _editions_cache = EditionsCache()
+        return _editions_cache
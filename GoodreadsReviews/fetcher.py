@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2011, Grant Drake <grant.drake@gmail.com>, 2016-2020 updates by David Forrester <davidfor@internode.on.net>'
+__docformat__ = 'restructuredtext en'
+
+import time
+from collections import namedtuple
+from io import BytesIO
+from threading import Event, Lock
+
+from calibre_plugins.goodreads import stats
+from calibre_plugins.goodreads.cache import HttpCache, page_type_for_url
+from calibre_plugins.goodreads.pool import create_transport, read_chunks
+from calibre_plugins.goodreads.throttle import (HostRateController, MAX_RETRIES,
+        backoff_delay, classify_error)
+
+
+class FetchAborted(Exception):
+    pass
+
+
+# leader is True for the caller that ran the function, shared is True if the
+# value was handed to more than one caller
+FlightResult = namedtuple('FlightResult', 'value leader shared')
+
+
+class _Call(object):
+
+    def __init__(self):
+        self.done = Event()
+        self.value = self.error = None
+        self.followers = 0
+
+
+class SingleFlight(object):
+
+    '''
+    Concurrent calls with the same key share one execution: the first caller
+    runs the function, the others wait for it and get the same result (or
+    exception). Nothing is remembered once the call completes.
+
+    Each caller passes its own abort event. A waiting caller stops as soon
+    as its abort is set, and one whose leader was aborted while it was not
+    runs the function itself rather than fail with the leader.
+    '''
+
+    def __init__(self):
+        self.lock = Lock()
+        self.calls = {}
+
+    def do(self, key, fn, args=(), abort=None):
+        '''
+        Returns a FlightResult of fn(*args). A shared value must not be
+        modified in place.
+        '''
+        aborted = lambda: abort is not None and abort.is_set()
+        while True:
+            with self.lock:
+                call = self.calls.get(key, None)
+                leader = call is None
+                if leader:
+                    call = self.calls[key] = _Call()
+                else:
+                    call.followers += 1
+            if leader:
+                break
+            while not call.done.wait(0.5):
+                if aborted():
+                    raise FetchAborted('Aborted while waiting for: %r' % (key,))
+            if isinstance(call.error, FetchAborted) and not aborted():
+                # The leader's caller gave up, this one did not
+                continue
+            if call.error is not None:
+                raise call.error
+            return FlightResult(call.value, False, True)
+        try:
+            call.value = fn(*args)
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+        return FlightResult(call.value, True, call.followers > 0)
+
+
+class Fetcher(object):
+
+    '''
+    Single entry point for all page downloads from Goodreads. Responses are
+    served from the persistent HttpCache while fresh, and revalidated with a
+    conditional request once they have expired. Requests that do go to the
+    network are paced per host by a HostRateController shared by all threads,
+    retried with backoff when Goodreads throttles us or times out, and sent
+    over the transport, normally a pool of keep-alive connections.
+    '''
+
+    def __init__(self, cache, limiter, transport=None):
+        self.cache = cache
+        self.limiter = limiter
+        self.transport = transport or create_transport()
+        self.counter_lock = Lock()
+        self.counters = {'hits': 0, 'revalidated': 0, 'misses': 0, 'retries': 0, 'shared': 0}
+        # Identical URLs requested at the same time are downloaded once
+        self.flight = SingleFlight()
+
+    def _count(self, name):
+        with self.counter_lock:
+            self.counters[name] += 1
+        stats.count(name)
+
+    def fetch(self, browser, url, timeout=30, log=None, page_type=None, abort=None,
+              consumer=None, revalidate=False):
+        '''
+        Return the body of url as bytes. Exceptions raised by the browser are
+        passed on unchanged so callers can keep inspecting 404s and timeouts.
+
+        If consumer is given the body is fed to it in chunks, see
+        pool.read_chunks, and only the part read before it asked to stop is
+        downloaded, returned and cached. Such a partial body is only used
+        again for callers with a consumer, which stop at the same place,
+        callers without one download the whole page.
+
+        With revalidate a cached page is revalidated even if it is still
+        fresh, to learn whether it changed at the cost of a conditional request.
+        '''
+        page_type = page_type or page_type_for_url(url)
+        cached = self.cache.get(url)
+        if cached is not None and not cached.complete and consumer is None:
+            # Not even revalidated, a 304 would keep the partial body
+            cached = None
+        if cached is not None and not revalidate and self.cache.is_fresh(cached):
+            self._count('hits')
+            if log is not None:
+                log.debug('Using cached page: %r' % url)
+            return self._replay(cached.body, consumer)
+
+        # A download stopped early by a consumer cannot be shared with a
+        # caller wanting the whole page
+        raw, leader, shared = self.flight.do((url, consumer is None), self._download,
+                                             (browser, url, cached, page_type, timeout, log,
+                                              abort, consumer), abort=abort)
+        if not leader:
+            # Another thread did the download, so consumer has not seen the body
+            self._count('shared')
+            if log is not None:
+                log.debug('Shared download of: %r' % url)
+            self._replay(raw, consumer)
+        return raw
+
+    def _download(self, browser, url, cached, page_type, timeout, log, abort, consumer):
+        headers = {}
+        if cached is not None:
+            if cached.etag:
+                headers['If-None-Match'] = cached.etag
+            if cached.last_modified:
+                headers['If-Modified-Since'] = cached.last_modified
+
+        try:
+            raw, info, finished = self._open(browser, url, headers, timeout, log, abort,
+                                             consumer)
+        except Exception as e:
+            if cached is not None and callable(getattr(e, 'getcode', None)) and \
+                    e.getcode() == 304:
+                self._count('revalidated')
+                self.cache.refresh(url)
+                return self._replay(cached.body, consumer)
+            raise
+
+        self._count('misses')
+        self.cache.put(url, page_type, raw, etag=info.get('ETag'),
+                       last_modified=info.get('Last-Modified'), complete=finished)
+        return raw
+
+    def fetch_uncached(self, browser, url, timeout=30, log=None, abort=None):
+        '''
+        Download url with the same pacing, retries and connections as fetch,
+        without storing it in the cache. Used for cover images.
+        '''
+        result = self.flight.do(('uncached', url), self._open,
+                                (browser, url, {}, timeout, log, abort), abort=abort)
+        return result.value[0]
+
+    def _replay(self, body, consumer):
+        if consumer is not None:
+            read_chunks(BytesIO(body), consumer)
+        return body
+
+    def _open(self, browser, url, headers, timeout, log, abort, consumer=None):
+        attempt = 0
+        while True:
+            if not self.limiter.acquire(url, abort):
+                raise FetchAborted('Aborted while waiting to download: %r' % url)
+            try:
+                with stats.timer('fetch:' + page_type_for_url(url)):
+                    raw, info, finished = self.transport.get(browser, url, headers, timeout,
+                                                             consumer)
+            except Exception as e:
+                retry, throttled, retry_after = classify_error(e)
+                if throttled:
+                    self.limiter.throttled(url, retry_after)
+                if not retry or attempt >= MAX_RETRIES:
+                    raise
+                delay = backoff_delay(attempt, retry_after)
+                attempt += 1
+                self._count('retries')
+                if log is not None:
+                    log.warning('Retrying %r in %.1fs (attempt %d of %d) after: %s' % (
+                        url, delay, attempt, MAX_RETRIES, e))
+                if abort is not None:
+                    if abort.wait(delay):
+                        raise FetchAborted('Aborted while waiting to retry: %r' % url)
+                else:
+                    time.sleep(delay)
+                continue
+            self.limiter.succeeded(url)
+            stats.count('fetch_bytes', len(raw))
+            return (raw, info, finished)
+
+
+_fetcher = None
+_fetcher_lock = Lock()
+
+
+def get_fetcher():
+    '''
+    The Fetcher is shared by every identify call and Worker in the process
+    '''
+    global _fetcher
+    with _fetcher_lock:
+        if _fetcher is None:
+            _fetcher = Fetcher(HttpCache(), HostRateController())
+        return _fetcher
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2011, Grant Drake <grant.drake@gmail.com>, 2016-2020 updates by David Forrester <davidfor@internode.on.net>'
+__docformat__ = 'restructuredtext en'
+
+from threading import Lock
+
+# Goodreads genres are paths like "Fiction > Science Fiction > Space Opera"
+SEPARATOR = ' > '
+# A mapping for "Fiction > *" applies to every genre under Fiction
+WILDCARD = '*'
+
+
+def _split(genre):
+    return tuple(part.strip().lower() for part in genre.split(SEPARATOR.strip()))
+
+
+class GenreMapper(object):
+
+    '''
+    The genre mappings of the plugin options, compiled once. Exact mappings
+    are looked up by the lower case genre, wildcard mappings by each parent
+    of the genre, so converting a book costs a few dict lookups whatever the
+    number of mappings.
+    '''
+
+    __slots__ = ('exact', 'prefixes')
+
+    def __init__(self, mappings):
+        exact, prefixes = {}, {}
+        for genre, tags in mappings.items():
+            path = _split(genre)
+            if path[-1] == WILDCARD:
+                target, key = prefixes, path[:-1]
+            else:
+                target, key = exact, path
+            # Names differing only in case are merged, keeping their tags in order
+            merged = target.setdefault(key, [])
+            merged.extend(tag for tag in tags if tag not in merged)
+        self.exact = dict((k, tuple(v)) for k, v in exact.items())
+        self.prefixes = dict((k, tuple(v)) for k, v in prefixes.items())
+
+    def tags_for(self, genre):
+        path = _split(genre)
+        tags = self.exact.get(path, ())
+        if self.prefixes:
+            for i in range(1, len(path)):
+                tags += self.prefixes.get(path[:i], ())
+        return tags
+
+    def convert(self, genres):
+        '''
+        The calibre tags for the list of genres, without duplicates, in the
+        order they are first mapped
+        '''
+        seen, tags = set(), []
+        for genre in genres:
+            for tag in self.tags_for(genre):
+                if tag not in seen:
+                    seen.add(tag)
+                    tags.append(tag)
+        return tags
+
+
+_mapper = None
+_mapper_lock = Lock()
+
+
+def get_genre_mapper(mappings):
+    '''
+    The mapper compiled from mappings, the genre mappings option. It is only
+    compiled again after invalidate_genre_mapper.
+    '''
+    global _mapper
+    with _mapper_lock:
+        if _mapper is None:
+            _mapper = GenreMapper(mappings)
+        return _mapper
+
+
+def invalidate_genre_mapper():
+    '''
+    Called when the mappings are saved, the next book compiles them again
+    '''
+    global _mapper
+    with _mapper_lock:
+        _mapper = None
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2011, Grant Drake <grant.drake@gmail.com>, 2016-2020 updates by David Forrester <davidfor@internode.on.net>'
+__docformat__ = 'restructuredtext en'
+
+import time
+from threading import Lock
+
+from calibre_plugins.goodreads.storage import SQLiteStore
+
+# Goodreads may add a book we could not find, so misses are forgotten after a week
+NEGATIVE_TTL = 7 * 24 * 60 * 60
+
+
+def is_amazon_identifier(identifier_name):
+    identifier_name = identifier_name.lower()
+    return identifier_name in ('amazon', 'asin', 'mobi-asin') or identifier_name.startswith('amazon_')
+
+
+def lookup_identifiers(identifiers):
+    '''
+    The ISBN and Amazon identifiers of a book that can be resolved to a
+    Goodreads id through the auto_complete API, in the order they are tried.
+    '''
+    from calibre.ebooks.metadata import check_isbn
+    values = []
+    isbn = check_isbn(identifiers.get('isbn', None))
+    if isbn:
+        values.append(isbn)
+    for identifier_name, identifier in identifiers.items():
+        if identifier and is_amazon_identifier(identifier_name):
+            values.append(identifier.strip().upper())
+    return values
+
+
+class IdentifierIndex(SQLiteStore):
+
+    '''
+    Persistent ISBN/ASIN to Goodreads id mappings. A goodreads_id of NULL
+    records that Goodreads had no match, which is trusted for NEGATIVE_TTL.
+    '''
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS identifiers (
+            identifier TEXT PRIMARY KEY,
+            goodreads_id TEXT,
+            updated REAL NOT NULL
+        );
+    '''
+
+    def __init__(self, path=None):
+        SQLiteStore.__init__(self, 'identifiers', path=path)
+
+    def lookup(self, identifier):
+        '''
+        Returns a tuple of (known, goodreads_id). known is False if we have to
+        ask Goodreads, goodreads_id is None for a remembered miss.
+        '''
+        rows = self.execute('SELECT goodreads_id, updated FROM identifiers WHERE identifier=?',
+                            (identifier,))
+        if not rows:
+            return (False, None)
+        goodreads_id, updated = rows[0]
+        if goodreads_id is None and time.time() - updated > NEGATIVE_TTL:
+            return (False, None)
+        return (True, goodreads_id)
+
+    def record(self, identifier, goodreads_id):
+        self.execute('INSERT OR REPLACE INTO identifiers (identifier, goodreads_id, updated)'
+                     ' VALUES (?, ?, ?)', (identifier, goodreads_id, time.time()))
+
+    def record_identifiers(self, identifiers):
+        '''
+        Remember the mappings implied by a book that already has both a
+        goodreads identifier and ISBN/Amazon identifiers.
+        '''
+        goodreads_id = identifiers.get('goodreads', None)
+        if not goodreads_id:
+            return 0
+        now = time.time()
+        rows = [(identifier, goodreads_id, now) for identifier in lookup_identifiers(identifiers)]
+        if rows:
+            self.executemany('INSERT OR REPLACE INTO identifiers (identifier, goodreads_id, updated)'
+                             ' VALUES (?, ?, ?)', rows)
+        return len(rows)
+
+    def warm_from_db(self, db):
+        '''
+        Load the mappings for every book in the calibre library that already
+        has a goodreads identifier
+        '''
+        api = db.new_api
+        all_identifiers = api.all_field_for('identifiers', api.all_book_ids())
+        now = time.time()
+        rows = []
+        for identifiers in all_identifiers.values():
+            goodreads_id = identifiers.get('goodreads', None)
+            if goodreads_id:
+                rows.extend((identifier, goodreads_id, now) for identifier in lookup_identifiers(identifiers))
+        self.executemany('INSERT OR REPLACE INTO identifiers (identifier, goodreads_id, updated)'
+                         ' VALUES (?, ?, ?)', rows)
+        return len(rows)
+
+
+_index = None
+_index_lock = Lock()
+
+
+def get_identifier_index():
+    '''
+    Shared index, warmed from the library open in the calibre GUI (if there is
+    one in this process) the first time it is used
+    '''
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = IdentifierIndex()
+            try:
+                from calibre.gui2.ui import get_gui
+                gui = get_gui()
+                if gui is not None and gui.current_db is not None:
+                    _index.warm_from_db(gui.current_db)
+            except Exception:
+                # Metadata download worker processes have no GUI, those rely
+                # on record_identifiers being called from identify instead
+                pass
+        return _index
@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2011, Grant Drake <grant.drake@gmail.com>, 2016-2020 updates by David Forrester <davidfor@internode.on.net>'
+__docformat__ = 'restructuredtext en'
+
+import socket, ssl, time, zlib
+from threading import BoundedSemaphore, Lock
+try:
+    from http.client import HTTPConnection, HTTPSConnection, HTTPException
+    from urllib.error import HTTPError, URLError
+    from urllib.parse import urljoin, urlsplit
+except ImportError:
+    from httplib import HTTPConnection, HTTPSConnection, HTTPException
+    from urllib2 import HTTPError, URLError
+    from urlparse import urljoin, urlsplit
+
+from calibre_plugins.goodreads import stats
+
+MAX_CONNECTIONS_PER_HOST = 6
+# Goodreads and its CDN close idle keep-alive connections after about a minute
+MAX_IDLE_TIME = 30
+MAX_REDIRECTS = 5
+# Size of the reads when the body is handed to a consumer as it arrives
+CHUNK_SIZE = 16 * 1024
+
+
+def read_chunks(response, consumer, decompress=None):
+    '''
+    Read a response in chunks, feeding each to consumer.feed until it returns
+    True. Returns a tuple of (body read so far, finished).
+    '''
+    consumer.reset()
+    data = []
+    while True:
+        chunk = response.read(CHUNK_SIZE)
+        if not chunk:
+            if decompress is not None:
+                chunk = decompress.flush()
+                if chunk:
+                    data.append(chunk)
+                    consumer.feed(chunk)
+            return (b''.join(data), True)
+        if decompress is not None:
+            chunk = decompress.decompress(chunk)
+            if not chunk:
+                continue
+        data.append(chunk)
+        if consumer.feed(chunk):
+            return (b''.join(data), False)
+
+
+def is_certificate_error(e):
+    # ssl.SSLCertVerificationError is Python 3.7 and later
+    return isinstance(e, getattr(ssl, 'SSLCertVerificationError', ())) or \
+        getattr(e, 'reason', None) == 'CERTIFICATE_VERIFY_FAILED'
+
+
+class BrowserTransport(object):
+
+    '''
+    Downloads with the calibre (mechanize) browser, one connection per request.
+    Used when a proxy is configured or the pooled transport cannot be used.
+    '''
+
+    def get(self, browser, url, headers, timeout, consumer=None):
+        # mechanize browsers are not thread safe and the browser is shared
+        browser = browser.clone_browser()
+        request = url
+        if headers:
+            from mechanize import Request
+            request = Request(url, headers=headers)
+        response = browser.open_novisit(request, timeout=timeout)
+        if consumer is None:
+            return (response.read(), response.info(), True)
+        try:
+            body, finished = read_chunks(response, consumer)
+        finally:
+            response.close()
+        return (body, response.info(), finished)
+
+
+class ConnectionPool(object):
+
+    '''
+    Keep-alive HTTP(S) connections shared by every Worker and identify call,
+    at most max_per_host open to any one host.
+    '''
+
+    def __init__(self, max_per_host=MAX_CONNECTIONS_PER_HOST, max_idle_time=MAX_IDLE_TIME):
+        self.max_per_host = max_per_host
+        self.max_idle_time = max_idle_time
+        self.lock = Lock()
+        self.idle = {}
+        self.slots = {}
+        self.ssl_context = ssl.create_default_context()
+        self.metrics = {'requests': 0, 'connections_created': 0, 'connections_reused': 0,
+                        'stale_retries': 0, 'truncated': 0}
+
+    def _count(self, name):
+        with self.lock:
+            self.metrics[name] += 1
+        stats.count(name)
+
+    def _slot(self, key):
+        with self.lock:
+            slot = self.slots.get(key, None)
+            if slot is None:
+                slot = self.slots[key] = BoundedSemaphore(self.max_per_host)
+            return slot
+
+    def _checkout(self, key, timeout):
+        now = time.time()
+        with self.lock:
+            idle = self.idle.setdefault(key, [])
+            while idle:
+                conn, last_used = idle.pop()
+                if now - last_used < self.max_idle_time:
+                    self.metrics['connections_reused'] += 1
+                    stats.count('connections_reused')
+                    conn.timeout = timeout
+                    if conn.sock is not None:
+                        conn.sock.settimeout(timeout)
+                    return (conn, True)
+                conn.close()
+            self.metrics['connections_created'] += 1
+        stats.count('connections_created')
+        scheme, host = key
+        if scheme == 'https':
+            return (HTTPSConnection(host, timeout=timeout, context=self.ssl_context), False)
+        return (HTTPConnection(host, timeout=timeout), False)
+
+    def _checkin(self, key, conn):
+        with self.lock:
+            self.idle.setdefault(key, []).append((conn, time.time()))
+
+    def request(self, url, headers, timeout, read_body=None):
+        '''
+        GET url, returns the HTTPResponse, its body, read by
+        read_body(response) if given, and whether the body was read to the
+        end. read_body returns a tuple of (body, finished), if the body was
+        not read to the end the connection is closed rather than put back in
+        the pool.
+        '''
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        self._count('requests')
+        slot = self._slot(key)
+        slot.acquire()
+        try:
+            while True:
+                conn, reused = self._checkout(key, timeout)
+                try:
+                    if not reused:
+                        with stats.timer('connect'):
+                            conn.connect()
+                    conn.request('GET', path, headers=headers)
+                    response = conn.getresponse()
+                except (HTTPException, socket.error) as e:
+                    conn.close()
+                    if reused and not isinstance(e, socket.timeout):
+                        # The server closed the idle connection under us, which
+                        # is normal for keep-alive, so try again on a new one
+                        self._count('stale_retries')
+                        continue
+                    raise
+                break
+            try:
+                if read_body is None:
+                    body, finished = response.read(), True
+                else:
+                    body, finished = read_body(response)
+            except:
+                conn.close()
+                raise
+            if not finished:
+                self._count('truncated')
+                conn.close()
+            elif response.will_close:
+                conn.close()
+            else:
+                self._checkin(key, conn)
+            return (response, body, finished)
+        finally:
+            slot.release()
+
+    def close(self):
+        with self.lock:
+            for connections in self.idle.values():
+                for conn, last_used in connections:
+                    conn.close()
+            self.idle = {}
+
+
+class PooledTransport(object):
+
+    '''
+    Downloads over the keep-alive connections of a ConnectionPool, so small
+    Goodreads pages don't each pay for a TCP and TLS handshake. Errors are
+    raised as the same HTTPError/URLError the calibre browser raises.
+    '''
+
+    def __init__(self, pool=None, fallback=None):
+        self.pool = pool or ConnectionPool()
+        self.fallback = fallback or BrowserTransport()
+        self.enabled = True
+
+    def get(self, browser, url, headers, timeout, consumer=None):
+        '''
+        Returns a tuple of (body, headers, finished). If consumer is given the
+        body is fed to it as it arrives, and the download stops as soon as
+        consumer.feed returns True, with finished False if that was before
+        the end of the body.
+        '''
+        if not self.enabled:
+            return self.fallback.get(browser, url, headers, timeout, consumer)
+        request_headers = {'Accept-Encoding': 'gzip', 'Connection': 'keep-alive'}
+        for name, value in getattr(browser, 'addheaders', None) or []:
+            request_headers[name] = value
+        request_headers.update(headers or {})
+
+        def read_body(response):
+            gzipped = response.getheader('Content-Encoding', '').lower() == 'gzip'
+            if consumer is None or response.status != 200:
+                body = response.read()
+                if gzipped:
+                    body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+                return (body, True)
+            return read_chunks(response, consumer,
+                    zlib.decompressobj(16 + zlib.MAX_WBITS) if gzipped else None)
+
+        for i in range(MAX_REDIRECTS + 1):
+            try:
+                response, body, finished = self.pool.request(url, request_headers, timeout,
+                                                             read_body)
+            except ssl.SSLError as e:
+                if is_certificate_error(e):
+                    # Certificates this Python cannot verify, leave it to calibre
+                    self.enabled = False
+                # Anything else (a reset or EOF in the handshake, a timeout) may
+                # be transient, the pool closed that connection and only this
+                # request goes through calibre
+                return self.fallback.get(browser, url, headers, timeout, consumer)
+            except socket.error as e:
+                raise URLError(e)
+            except HTTPException as e:
+                raise URLError(e)
+            status = response.status
+            if status in (301, 302, 303, 307, 308):
+                location = response.getheader('Location')
+                if not location:
+                    break
+                url = urljoin(url, location)
+                continue
+            if status >= 300:
+                raise HTTPError(url, status, response.reason, response.msg, None)
+            return (body, response.msg, finished)
+        raise HTTPError(url, status, 'Too many redirects', response.msg, None)
+
+
+def create_transport():
+    '''
+    The pooled transport, unless calibre has proxies configured which only the
+    calibre browser knows how to use
+    '''
+    try:
+        from calibre import get_proxies
+        proxies = get_proxies(debug=False)
+    except Exception:
+        proxies = None
+    if proxies:
+        return BrowserTransport()
+    return PooledTransport()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2011, Grant Drake <grant.drake@gmail.com>, 2016-2020 updates by David Forrester <davidfor@internode.on.net>'
+__docformat__ = 'restructuredtext en'
+
+import math, re
+from collections import namedtuple
+
+from lxml import etree
+
+from calibre_plugins.goodreads.structured import split_series
+
+# Candidates scoring less than this are not worth a detail page, unless
+# nothing scores more
+MIN_SCORE = 0.5
+# Weights of the parts of the score, they add up to 1
+TITLE_WEIGHT = 0.6
+AUTHOR_WEIGHT = 0.3
+POPULARITY_WEIGHT = 0.1
+# A book with this many ratings gets the full popularity part of the score
+POPULAR_RATINGS = 1000000
+
+SearchResult = namedtuple('SearchResult', 'url title authors ratings year editions_text editions_url')
+
+XPATH_RESULT_TITLE = etree.XPath('./a')
+XPATH_RESULT_AUTHOR = etree.XPath('./span[@itemprop="author"]/div/a/span')
+XPATH_RESULT_DETAILS = etree.XPath('./div')
+XPATH_RESULT_EDITIONS = etree.XPath('./span/a[@href]')
+
+WORD = re.compile(r'\w+', re.UNICODE)
+# "4.26 avg rating — 1,234,567 ratings — published 1965 — 45 editions"
+RATINGS = re.compile(r'([\d,]+)\s+ratings?\b')
+PUBLISHED = re.compile(r'published\s+(\d{4})')
+
+
+def search_result_for_row(row, base_url):
+    '''
+    The SearchResult for a row (the second cell) of the search results
+    table, or None if the row has no book details
+    '''
+    link = XPATH_RESULT_TITLE(row)
+    details = XPATH_RESULT_DETAILS(row)
+    if not link or not details:
+        return None
+    title = link[0].text_content().strip()
+    authors = XPATH_RESULT_AUTHOR(row)
+    authors = authors[0].text_content().strip().split(',') if authors else []
+    text = details[0].text_content()
+    ratings = RATINGS.search(text)
+    ratings = int(ratings.group(1).replace(',', '')) if ratings else 0
+    year = PUBLISHED.search(text)
+    year = int(year.group(1)) if year else None
+    editions_text = editions_url = None
+    for editions_link in XPATH_RESULT_EDITIONS(details[0]):
+        editions_text = editions_link.text
+        if editions_text == '1 edition':
+            break
+        if '/work/editions/' in editions_link.get('href'):
+            editions_url = base_url + editions_link.get('href')
+            break
+    return SearchResult(base_url + link[0].get('href'), title, authors, ratings, year,
+                        editions_text, editions_url)
+
+
+def word_tokens(text):
+    return frozenset(w.lower() for w in WORD.findall(text or ''))
+
+
+def token_similarity(query, candidate):
+    '''
+    Mostly the share of the query tokens found in the candidate, with a bit
+    of their Jaccard index so that extra words count against a candidate.
+    An empty query matches everything.
+    '''
+    if not query:
+        return 1.0
+    if not candidate:
+        return 0.0
+    common = len(query & candidate)
+    return 0.8 * common / len(query) + 0.2 * common / len(query | candidate)
+
+
+def score(result, title_tokens, author_tokens):
+    '''
+    Score from 0 to 1 of how likely result is the book asked for. Token sets
+    are as returned by word_tokens.
+    '''
+    title_score = token_similarity(title_tokens, word_tokens(split_series(result.title)[0]))
+    author_score = token_similarity(author_tokens, word_tokens(' '.join(result.authors)))
+    popularity = min(1.0, math.log10(result.ratings + 1) / math.log10(POPULAR_RATINGS))
+    return TITLE_WEIGHT * title_score + AUTHOR_WEIGHT * author_score + POPULARITY_WEIGHT * popularity
+
+
+def rank(results, title_tokens, author_tokens, max_candidates, min_score=MIN_SCORE):
+    '''
+    Returns ([(score, result)], skipped): the results worth fetching the
+    detail page of, best first, and the number of results left out. At most
+    max_candidates results scoring min_score or more are kept. If none
+    score that much the best one is kept, a weak match being better than
+    none.
+    '''
+    title_tokens = frozenset(t.lower() for t in title_tokens)
+    author_tokens = frozenset(t.lower() for t in author_tokens)
+    # Ties keep the order of the search results, the order Goodreads ranks them
+    scored = sorted(((score(result, title_tokens, author_tokens), i, result)
+                     for i, result in enumerate(results)), key=lambda s: (-s[0], s[1]))
+    selected = [s for s in scored if s[0] >= min_score][:max_candidates] or scored[:1]
+    return ([(s, result) for s, i, result in selected], len(scored) - len(selected))
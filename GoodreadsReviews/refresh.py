@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2011, Grant Drake <grant.drake@gmail.com>, 2016-2020 updates by David Forrester <davidfor@internode.on.net>'
+__docformat__ = 'restructuredtext en'
+
+import hashlib, json, sys, time
+from collections import namedtuple
+from threading import Event
+from six import text_type as unicode
+
+from calibre_plugins.goodreads.storage import SQLiteStore
+
+USAGE = '''\
+Refresh the Goodreads metadata of a whole library. Run with the plugin installed:
+
+    calibre-debug -e refresh.py <library> [--changed-only] [--restart] [--apply]
+        Identify every book of the library, a chunk at a time. Progress is
+        saved after each chunk, so a refresh that was interrupted carries on
+        where it stopped when run again. --restart forgets that progress.
+        --changed-only only identifies again the books already refreshed
+        whose Goodreads page changed since (by its ETag). --apply writes the
+        metadata found to the library, for the books where it changed.
+'''
+
+# Books identified between two checkpoints
+CHUNK_SIZE = 50
+
+STATE_DONE = 'done'
+STATE_NOT_FOUND = 'not_found'
+# Books in these states are not identified again when a job is resumed
+COMPLETED_STATES = (STATE_DONE, STATE_NOT_FOUND)
+
+# etag is the ETag of url, the book page the metadata was read from
+Checkpoint = namedtuple('Checkpoint', 'book_id state goodreads_id fetched result_hash etag url')
+
+
+class CheckpointStore(SQLiteStore):
+
+    '''
+    Persistent progress of refresh jobs: the state of each book of a job,
+    with the Goodreads id found, when, a hash of the metadata and the ETag
+    of the book page, and its URL. Jobs are named, usually by the library
+    they refresh.
+    '''
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS checkpoints (
+            job TEXT NOT NULL,
+            book_id TEXT NOT NULL,
+            state TEXT NOT NULL,
+            goodreads_id TEXT,
+            fetched REAL NOT NULL,
+            result_hash TEXT,
+            etag TEXT,
+            url TEXT,
+            PRIMARY KEY (job, book_id)
+        );
+    '''
+
+    def __init__(self, path=None):
+        SQLiteStore.__init__(self, 'refresh', path=path)
+        # Checkpoints saved by older versions have no url
+        columns = [row[1] for row in self.execute('PRAGMA table_info(checkpoints)')]
+        if 'url' not in columns:
+            self.execute('ALTER TABLE checkpoints ADD COLUMN url TEXT')
+
+    def get_all(self, job):
+        rows = self.execute('SELECT book_id, state, goodreads_id, fetched, result_hash, etag, url'
+                            ' FROM checkpoints WHERE job=?', (job,))
+        return dict((row[0], Checkpoint(*row)) for row in rows)
+
+    def put_many(self, job, checkpoints):
+        '''
+        Save the checkpoints of a chunk of books in one transaction
+        '''
+        self.executemany('INSERT OR REPLACE INTO checkpoints'
+                         ' (job, book_id, state, goodreads_id, fetched, result_hash, etag, url)'
+                         ' VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                         [(job,) + tuple(c) for c in checkpoints])
+
+    def clear(self, job):
+        self.execute('DELETE FROM checkpoints WHERE job=?', (job,))
+
+
+def result_hash(mi):
+    '''
+    Hash of the fields of a Metadata found by identify, to tell whether a
+    refresh found anything new
+    '''
+    fields = dict((field, mi.get(field, None)) for field in (
+        'title', 'authors', 'series', 'series_index', 'tags', 'rating',
+        'publisher', 'pubdate', 'comments', 'language'))
+    fields['identifiers'] = mi.get_identifiers()
+    data = json.dumps(fields, sort_keys=True, default=unicode)
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+RefreshCounts = namedtuple('RefreshCounts', 'skipped unchanged identified not_found changed')
+
+
+class RefreshJob(object):
+
+    '''
+    Identify many books with Goodreads.identify_batch, a chunk at a time,
+    saving a checkpoint per book after each chunk. Books completed by an
+    earlier run of the same job are skipped.
+
+    With changed_only, only the books completed by an earlier run are
+    considered and those whose book page still has the ETag recorded then
+    are skipped. Checking costs a conditional request per book, even for
+    pages still fresh in the cache, answered with 304 Not Modified when
+    nothing changed.
+    '''
+
+    def __init__(self, plugin, log, job, store=None, abort=None, timeout=30,
+                 chunk_size=CHUNK_SIZE):
+        self.plugin, self.log, self.job = plugin, log, job
+        self.store = store if store is not None else CheckpointStore()
+        self.abort = abort if abort is not None else Event()
+        self.timeout, self.chunk_size = timeout, chunk_size
+
+    def book_url(self, goodreads_id):
+        # The URL identify downloads for a book with a goodreads identifier
+        return '%s/book/show/%s-aaaa' % (self.plugin.BASE_URL, goodreads_id)
+
+    def current_etag(self, url):
+        '''
+        The ETag of the book page at url now, always asking Goodreads. None
+        if Goodreads does not send one.
+        '''
+        from calibre_plugins.goodreads.fetcher import get_fetcher
+        from calibre_plugins.goodreads.worker import DetailsPageScanner
+        fetcher = get_fetcher()
+        # Read like the Worker does, so its cached page is revalidated rather
+        # than downloaded again in full, and only its head if it did change
+        fetcher.fetch(self.plugin.browser, url, timeout=self.timeout, log=self.log,
+                      abort=self.abort, consumer=DetailsPageScanner(), revalidate=True)
+        return self.cached_etag(url)
+
+    def cached_etag(self, url):
+        from calibre_plugins.goodreads.fetcher import get_fetcher
+        cached = get_fetcher().cache.get(url)
+        return cached.etag if cached is not None else None
+
+    def run(self, books, changed_only=False, callback=None):
+        '''
+        books is a list of (book_id, title, authors, identifiers). callback,
+        if given, is called with (book_id, mi) for each book whose metadata
+        is not the same as found by the previous refresh. Returns the
+        RefreshCounts of this run.
+        '''
+        checkpoints = self.store.get_all(self.job)
+        counts = dict((name, 0) for name in RefreshCounts._fields)
+        todo = []
+        for book in books:
+            checkpoint = checkpoints.get(unicode(book[0]), None)
+            if changed_only:
+                if checkpoint is None or checkpoint.state != STATE_DONE or not checkpoint.goodreads_id:
+                    counts['skipped'] += 1
+                    continue
+                # Straight to the book page checked, even if the library has no goodreads id
+                identifiers = dict(book[3] or {})
+                identifiers[self.plugin.ID_NAME] = checkpoint.goodreads_id
+                book = tuple(book[:3]) + (identifiers,)
+            elif checkpoint is not None and checkpoint.state in COMPLETED_STATES:
+                counts['skipped'] += 1
+                continue
+            todo.append(book)
+        if changed_only:
+            changed = self._changed(todo, checkpoints)
+            counts['unchanged'] = len(todo) - len(changed)
+            todo = changed
+
+        self.log.info('Refreshing %d of %d books' % (len(todo), len(books)))
+        for start in range(0, len(todo), self.chunk_size):
+            if self.abort.is_set():
+                break
+            chunk = todo[start:start + self.chunk_size]
+            self._run_chunk(chunk, checkpoints, counts, callback)
+            self.log.info('Refreshed %d of %d books' % (min(start + self.chunk_size, len(todo)), len(todo)))
+        return RefreshCounts(**counts)
+
+    def _changed(self, books, checkpoints):
+        '''
+        The books whose page ETag is not the one recorded in their
+        checkpoint, checked in parallel on the shared executor
+        '''
+        from concurrent.futures import wait
+        import calibre_plugins.goodreads.config as cfg
+        from calibre_plugins.goodreads.throttle import get_executor
+
+        def changed(book):
+            checkpoint = checkpoints[unicode(book[0])]
+            if self.abort.is_set():
+                return False
+            try:
+                etag = self.current_etag(checkpoint.url or self.book_url(checkpoint.goodreads_id))
+            except Exception:
+                self.log.exception('Failed to check for changes of book: %s' % checkpoint.book_id)
+                return False
+            return etag is None or etag != checkpoint.etag
+
+        executor = get_executor(cfg.get_settings().max_downloads)
+        futures = [executor.submit(changed, book) for book in books]
+        wait(futures)
+        return [book for book, future in zip(books, futures) if future.result()]
+
+    def _run_chunk(self, chunk, checkpoints, counts, callback):
+        results = self.plugin.identify_batch(self.log, [book[1:] for book in chunk],
+                                             self.abort, timeout=self.timeout)
+        if self.abort.is_set():
+            # Books not identified because of the abort are not not found
+            return
+        now = time.time()
+        saved = []
+        for (book_id, title, authors, identifiers), found in zip(chunk, results):
+            book_id = unicode(book_id)
+            if not found:
+                counts['not_found'] += 1
+                saved.append(Checkpoint(book_id, STATE_NOT_FOUND, None, now, None, None, None))
+                continue
+            found.sort(key=self.plugin.identify_results_keygen(
+                title=title, authors=authors, identifiers=identifiers))
+            mi = found[0]
+            goodreads_id = mi.get_identifiers().get(self.plugin.ID_NAME, None)
+            digest = result_hash(mi)
+            # The page the Worker read, found by a search or from the goodreads id
+            url = getattr(mi, 'details_url', None) or (
+                self.book_url(goodreads_id) if goodreads_id else None)
+            etag = self.cached_etag(url) if url else None
+            saved.append(Checkpoint(book_id, STATE_DONE, goodreads_id, now, digest, etag, url))
+            counts['identified'] += 1
+            previous = checkpoints.get(book_id, None)
+            if previous is None or previous.result_hash != digest:
+                counts['changed'] += 1
+                if callback is not None:
+                    callback(book_id, mi)
+        self.store.put_many(self.job, saved)
+
+
+def load_plugin():
+    from calibre.customize.ui import metadata_plugins
+    for plugin in metadata_plugins(['identify']):
+        if plugin.name == 'GoodreadsReviews':
+            return plugin
+    raise SystemExit('The GoodreadsReviews plugin is not installed')
+
+
+def main(args):
+    import argparse, os
+    from calibre.library import db as open_db
+    from calibre.utils.logging import default_log
+    parser = argparse.ArgumentParser(prog='refresh.py', usage=USAGE)
+    parser.add_argument('library')
+    parser.add_argument('--changed-only', action='store_true')
+    parser.add_argument('--restart', action='store_true')
+    parser.add_argument('--apply', action='store_true')
+    opts = parser.parse_args(args)
+    api = open_db(opts.library).new_api
+    books = [(book_id, api.field_for('title', book_id), list(api.field_for('authors', book_id)),
+              api.field_for('identifiers', book_id)) for book_id in api.all_book_ids()]
+    job = RefreshJob(load_plugin(), default_log, os.path.abspath(opts.library))
+    if opts.restart:
+        job.store.clear(job.job)
+
+    def apply(book_id, mi):
+        api.set_metadata(int(book_id), mi, ignore_errors=True)
+
+    try:
+        counts = job.run(books, changed_only=opts.changed_only,
+                         callback=apply if opts.apply else None)
+    except KeyboardInterrupt:
+        job.abort.set()
+        raise SystemExit('Interrupted, run again to carry on')
+    print('skipped=%d unchanged=%d identified=%d not_found=%d changed=%d' % counts)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
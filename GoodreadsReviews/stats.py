@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2011, Grant Drake <grant.drake@gmail.com>, 2016-2020 updates by David Forrester <davidfor@internode.on.net>'
+__docformat__ = 'restructuredtext en'
+
+# Timings and counters of identify runs, enabled by KEY_COLLECT_TIMINGS. When
+# no run is being collected every function here returns after a single check,
+# so the calls can stay in the download and parse paths.
+#
+# Stages are named by what they time, for example:
+#   connect             DNS, TCP and TLS for a new pooled connection
+#   fetch:<page type>   download of a page, including streaming parse
+#   clean_html, html5_parse, stream_parse
+#   field:<name>        extraction of one field by the Worker
+# and counters are the number of bytes downloaded, cache hits and so on.
+
+import json, os, time
+from threading import Lock
+try:
+    from time import perf_counter as clock
+except ImportError:
+    from time import time as clock
+
+TIMINGS_FOLDER = 'timings'
+# Only the most recent JSON dumps are kept
+MAX_TIMING_FILES = 20
+
+
+class RunStats(object):
+
+    def __init__(self):
+        self.lock = Lock()
+        self.started = time.time()
+        # stage -> [calls, total ms, max ms]
+        self.timings = {}
+        self.counters = {}
+
+    def add_time(self, stage, ms):
+        with self.lock:
+            timing = self.timings.get(stage, None)
+            if timing is None:
+                self.timings[stage] = [1, ms, ms]
+            else:
+                timing[0] += 1
+                timing[1] += ms
+                timing[2] = max(timing[2], ms)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def as_dict(self):
+        with self.lock:
+            return {
+                'started': self.started,
+                'elapsed_ms': (time.time() - self.started) * 1000,
+                'timings': dict((stage, {'calls': calls, 'total_ms': total, 'max_ms': longest})
+                                for stage, (calls, total, longest) in self.timings.items()),
+                'counters': dict(self.counters),
+            }
+
+    def summary(self):
+        data = self.as_dict()
+        lines = ['Goodreads timings for %.0fms:' % data['elapsed_ms'],
+                 '  %-28s %8s %12s %10s %10s' % ('stage', 'calls', 'total ms', 'mean ms', 'max ms')]
+        for stage in sorted(data['timings']):
+            t = data['timings'][stage]
+            lines.append('  %-28s %8d %12.1f %10.2f %10.1f' % (
+                stage, t['calls'], t['total_ms'], t['total_ms'] / t['calls'], t['max_ms']))
+        for name in sorted(data['counters']):
+            lines.append('  %-28s %8d' % (name, data['counters'][name]))
+        return '\n'.join(lines)
+
+    def dump(self, folder):
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        path = os.path.join(folder, 'identify-%s-%d.json' % (
+            time.strftime('%Y%m%d-%H%M%S', time.localtime(self.started)), os.getpid()))
+        with open(path, 'w') as f:
+            json.dump(self.as_dict(), f, indent=1, sort_keys=True)
+        names = sorted(n for n in os.listdir(folder) if n.endswith('.json'))
+        for name in names[:-MAX_TIMING_FILES]:
+            try:
+                os.remove(os.path.join(folder, name))
+            except EnvironmentError:
+                pass
+        return path
+
+
+_run = None
+_users = 0
+_lock = Lock()
+
+
+def begin_run(settings):
+    '''
+    Start collecting, if enabled in settings (see config.get_settings). Runs
+    overlapping in time (calibre identifies several books at once) are
+    collected together and reported when the last one ends. Returns True if
+    end_run has to be called.
+    '''
+    global _run, _users
+    if not settings.collect_timings:
+        return False
+    with _lock:
+        if _run is None:
+            _run = RunStats()
+        _users += 1
+    return True
+
+
+def end_run(log):
+    global _run, _users
+    with _lock:
+        _users -= 1
+        if _users > 0:
+            return
+        run, _run = _run, None
+    if run is None:
+        return
+    log.info(run.summary())
+    try:
+        from calibre_plugins.goodreads.storage import get_storage_dir
+        storage_dir = get_storage_dir()
+        if storage_dir is not None:
+            log.info('Timings saved to: %s' % run.dump(os.path.join(storage_dir, TIMINGS_FOLDER)))
+    except EnvironmentError:
+        log.exception('Failed to save timings')
+
+
+def enabled():
+    return _run is not None
+
+
+def add_time(stage, ms):
+    run = _run
+    if run is not None:
+        run.add_time(stage, ms)
+
+
+def count(name, n=1):
+    run = _run
+    if run is not None:
+        run.count(name, n)
+
+
+class timer(object):
+
+    '''
+    Context manager adding the time spent in its block to stage
+    '''
+
+    __slots__ = ('stage', 'start')
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.start = None
+
+    def __enter__(self):
+        if _run is not None:
+            self.start = clock()
+        return self
+
+    def __exit__(self, *args):
+        if self.start is not None:
+            add_time(self.stage, (clock() - self.start) * 1000)
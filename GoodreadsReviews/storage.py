@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2011, Grant Drake <grant.drake@gmail.com>, 2016-2020 updates by David Forrester <davidfor@internode.on.net>'
+__docformat__ = 'restructuredtext en'
+
+import os, sqlite3
+from threading import RLock
+
+STORAGE_FOLDER = 'goodreads'
+
+
+def get_storage_dir():
+    '''
+    Folder in the calibre cache directory holding the persistent stores used
+    by this plugin. Falls back to None if it cannot be created, in which case
+    the stores are kept in memory for the life of the process.
+    '''
+    try:
+        from calibre.constants import cache_dir
+        path = os.path.join(cache_dir(), STORAGE_FOLDER)
+        if not os.path.exists(path):
+            os.makedirs(path)
+        return path
+    except Exception:
+        return None
+
+
+class SQLiteStore(object):
+
+    '''
+    Base class for the small persistent stores of this plugin. Each store is a
+    single SQLite file in the plugin storage folder, shared by all threads of
+    the process (and by concurrent calibre processes, through SQLite locking).
+    '''
+
+    SCHEMA = ''
+
+    def __init__(self, name, path=None):
+        if path is None:
+            storage_dir = get_storage_dir()
+            path = os.path.join(storage_dir, name + '.sqlite') if storage_dir else ':memory:'
+        self.path = path
+        self.lock = RLock()
+        try:
+            self.conn = self._connect(path)
+        except sqlite3.Error:
+            # Corrupt or unwritable file, we can always work without it
+            self.path = ':memory:'
+            self.conn = self._connect(self.path)
+
+    def _connect(self, path):
+        conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        if path != ':memory:':
+            conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.executescript(self.SCHEMA)
+        return conn
+
+    def execute(self, sql, args=()):
+        with self.lock:
+            with self.conn:
+                return self.conn.execute(sql, args).fetchall()
+
+    def executemany(self, sql, seq_of_args):
+        with self.lock:
+            with self.conn:
+                self.conn.executemany(sql, seq_of_args)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2011, Grant Drake <grant.drake@gmail.com>, 2016-2020 updates by David Forrester <davidfor@internode.on.net>'
+__docformat__ = 'restructuredtext en'
+
+import datetime, json, re
+
+from lxml import etree
+
+XPATH_JSON_LD = etree.XPath('//script[@type="application/ld+json"]/text()')
+XPATH_NEXT_DATA = etree.XPath('//script[@id="__NEXT_DATA__"]/text()')
+
+# "Title (Series Name, #1)" or "Title (Series Name #1-3)"
+TITLE_WITH_SERIES = re.compile(r'^(.*?)\s*\(([^()]+?),?\s+#([\d.]+)(?:-[\d.]+)?\)$')
+
+SOURCE_NEXT_DATA = 'next_data'
+SOURCE_JSON_LD = 'json_ld'
+
+
+class StructuredData(object):
+
+    '''
+    The fields of a book taken from the JSON Goodreads embeds in its pages:
+    the Apollo state in __NEXT_DATA__ on the current layout, and the JSON-LD
+    Book object. Each payload is loaded once. fields maps a field name to its
+    value and sources maps it to the payload it came from, a field that is
+    missing from both is not in either dict.
+
+    Field values: title, authors (list of (name, role)), series (tuple of
+    (name, index)), isbn, asin, rating (0-5), rating_count, comments (html),
+    cover, genres (list of names), publication (tuple of (publisher,
+    pubdate)) and language (as named on the page).
+    '''
+
+    def __init__(self, root):
+        self.fields = {}
+        self.sources = {}
+        for text in XPATH_NEXT_DATA(root):
+            self._add(SOURCE_NEXT_DATA, next_data_fields(_loads(text)))
+        for text in XPATH_JSON_LD(root):
+            self._add(SOURCE_JSON_LD, json_ld_fields(_loads(text)))
+
+    def _add(self, source, fields):
+        for name, value in fields.items():
+            if value and name not in self.fields:
+                self.fields[name] = value
+                self.sources[name] = source
+
+    def get(self, name):
+        return self.fields.get(name, None)
+
+
+def _loads(text):
+    try:
+        return json.loads(text)
+    except ValueError:
+        return None
+
+
+def _number(value, kind=float):
+    try:
+        return kind(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _date_from_millis(value):
+    value = _number(value)
+    if value is None:
+        return None
+    from calibre.utils.date import utc_tz
+    return datetime.datetime(1970, 1, 1, tzinfo=utc_tz) + datetime.timedelta(milliseconds=value)
+
+
+def split_series(title):
+    '''
+    Returns (title, (series, series_index)) for a title with the series
+    appended, or (title, None)
+    '''
+    match = TITLE_WITH_SERIES.match(title or '')
+    if match is None:
+        return (title, None)
+    return (match.group(1), (match.group(2).strip(), float(match.group(3))))
+
+
+def json_ld_fields(data):
+    if isinstance(data, dict) and '@graph' in data:
+        data = data['@graph']
+    candidates = data if isinstance(data, list) else [data]
+    book = None
+    for candidate in candidates:
+        if not isinstance(candidate, dict):
+            continue
+        kind = candidate.get('@type', None)
+        if kind == 'Book' or (isinstance(kind, list) and 'Book' in kind):
+            book = candidate
+            break
+    if book is None:
+        return {}
+    title, series = split_series(book.get('name', None))
+    authors = book.get('author', None) or []
+    if isinstance(authors, dict):
+        authors = [authors]
+    rating = book.get('aggregateRating', None) or {}
+    language = book.get('inLanguage', None)
+    return {
+        'title': title,
+        'series': series,
+        'authors': [(a['name'], '') for a in authors if isinstance(a, dict) and a.get('name')],
+        'isbn': book.get('isbn', None),
+        'rating': _number(rating.get('ratingValue', None)),
+        'rating_count': _number(rating.get('ratingCount', None), int),
+        'cover': book.get('image', None),
+        'language': language if isinstance(language, type('')) else None,
+    }
+
+
+def next_data_fields(data):
+    try:
+        state = data['props']['pageProps']['apolloState']
+    except (KeyError, TypeError):
+        return {}
+
+    def ref(value):
+        if isinstance(value, dict) and '__ref' in value:
+            return state.get(value['__ref'], None) or {}
+        return value or {}
+
+    book = None
+    for key, value in (state.get('ROOT_QUERY', None) or {}).items():
+        if key.startswith('getBookByLegacyId'):
+            book = ref(value)
+            break
+    if not book:
+        for key, value in state.items():
+            if key.startswith('Book:') and value.get('title', None):
+                book = value
+                break
+    if not book:
+        return {}
+
+    authors = []
+    primary = book.get('primaryContributorEdge', None) or {}
+    for edge in [primary] + (book.get('secondaryContributorEdges', None) or []):
+        name = ref(edge.get('node', None)).get('name', None)
+        if name:
+            role = edge.get('role', None) or ''
+            authors.append((name, '' if role == 'Author' else role))
+
+    series = None
+    for position in book.get('bookSeries', None) or []:
+        name = ref(position.get('series', None)).get('title', None)
+        index = _number(position.get('userPosition', None))
+        if name:
+            series = (name, index)
+            break
+
+    details = book.get('details', None) or {}
+    work = ref(book.get('work', None))
+    stats = work.get('stats', None) or {}
+    # Like the book page, prefer the date the work was first published
+    published = (work.get('details', None) or {}).get('publicationTime', None) or \
+            details.get('publicationTime', None)
+    publication = (details.get('publisher', None) or None, _date_from_millis(published))
+    language = (details.get('language', None) or {}).get('name', None)
+    return {
+        'title': book.get('title', None),
+        'series': series,
+        'authors': authors,
+        'isbn': details.get('isbn13', None) or details.get('isbn', None),
+        'asin': details.get('asin', None),
+        'rating': _number(stats.get('averageRating', None)),
+        'rating_count': _number(stats.get('ratingsCount', None), int),
+        'comments': book.get('description', None),
+        'cover': book.get('imageUrl', None),
+        'genres': [g['genre']['name'] for g in book.get('bookGenres', None) or []
+                   if (g.get('genre', None) or {}).get('name', None)],
+        'publication': publication if any(publication) else None,
+        'language': language,
+    }
@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2011, Grant Drake <grant.drake@gmail.com>, 2016-2020 updates by David Forrester <davidfor@internode.on.net>'
+__docformat__ = 'restructuredtext en'
+
+import random, socket, time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+# Default pace of requests sent to Goodreads, shared by all identify calls
+REQUESTS_PER_SECOND = 5.0
+REQUEST_BURST = 5
+# When throttled the rate is halved, down to MIN_REQUESTS_PER_SECOND, then
+# increased by RATE_INCREASE for every successful request after that
+MIN_REQUESTS_PER_SECOND = 0.2
+RATE_INCREASE = 0.05
+
+# Retries of failed GETs, waiting BACKOFF_BASE * 2**attempt seconds (with
+# jitter, capped at BACKOFF_MAX) or whatever the server asks in Retry-After
+MAX_RETRIES = 4
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 60.0
+RETRY_STATUS_CODES = frozenset([429, 500, 502, 503, 504])
+THROTTLE_STATUS_CODES = frozenset([429, 503])
+
+
+class TokenBucket(object):
+
+    '''
+    Classic token bucket: tokens are added at rate per second up to capacity,
+    and each request takes one, waiting for it if the bucket is empty.
+    '''
+
+    def __init__(self, rate=REQUESTS_PER_SECOND, capacity=REQUEST_BURST):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.updated = time.time()
+        self.blocked_until = 0
+        self.lock = Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, abort=None):
+        '''
+        Block until a token is available. Returns False if abort was set
+        while waiting.
+        '''
+        while True:
+            with self.lock:
+                now = time.time()
+                self._refill(now)
+                if now < self.blocked_until:
+                    wait = self.blocked_until - now
+                elif self.tokens >= 1:
+                    self.tokens -= 1
+                    return True
+                else:
+                    wait = (1 - self.tokens) / self.rate
+            if abort is not None:
+                if abort.wait(wait):
+                    return False
+            else:
+                time.sleep(wait)
+
+
+class AdaptiveTokenBucket(TokenBucket):
+
+    '''
+    Token bucket whose rate backs off multiplicatively when the server
+    throttles us, and creeps back up additively while requests succeed.
+    '''
+
+    def __init__(self, rate=REQUESTS_PER_SECOND, capacity=REQUEST_BURST,
+                 min_rate=MIN_REQUESTS_PER_SECOND, increase=RATE_INCREASE):
+        TokenBucket.__init__(self, rate, capacity)
+        self.max_rate = float(rate)
+        self.min_rate = float(min_rate)
+        self.increase = float(increase)
+
+    def throttled(self, retry_after=None):
+        with self.lock:
+            self._refill(time.time())
+            self.rate = max(self.min_rate, self.rate / 2)
+            # Don't let a full bucket burst straight back into the throttling
+            self.tokens = min(self.tokens, 0)
+            if retry_after:
+                self.blocked_until = max(self.blocked_until, time.time() + retry_after)
+
+    def succeeded(self):
+        if self.rate < self.max_rate:
+            with self.lock:
+                self._refill(time.time())
+                self.rate = min(self.max_rate, self.rate + self.increase)
+
+
+class HostRateController(object):
+
+    '''
+    One AdaptiveTokenBucket per host, so throttling by www.goodreads.com does
+    not slow down the image CDN and the other way round.
+    '''
+
+    def __init__(self, rate=REQUESTS_PER_SECOND, capacity=REQUEST_BURST):
+        self.rate, self.capacity = rate, capacity
+        self.buckets = {}
+        self.lock = Lock()
+
+    def bucket(self, url):
+        host = host_for_url(url)
+        with self.lock:
+            bucket = self.buckets.get(host, None)
+            if bucket is None:
+                bucket = self.buckets[host] = AdaptiveTokenBucket(self.rate, self.capacity)
+            return bucket
+
+    def acquire(self, url, abort=None):
+        return self.bucket(url).acquire(abort)
+
+    def throttled(self, url, retry_after=None):
+        self.bucket(url).throttled(retry_after)
+
+    def succeeded(self, url):
+        self.bucket(url).succeeded()
+
+
+def host_for_url(url):
+    try:
+        from urllib.parse import urlsplit
+    except ImportError:
+        from urlparse import urlsplit
+    return urlsplit(url).netloc.lower()
+
+
+def parse_retry_after(value):
+    '''
+    Retry-After is either a number of seconds or an HTTP date
+    '''
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        from email.utils import mktime_tz, parsedate_tz
+        return max(0.0, mktime_tz(parsedate_tz(value)) - time.time())
+    except Exception:
+        return None
+
+
+def classify_error(e):
+    '''
+    Returns a tuple of (retry, throttled, retry_after) for an exception raised
+    while downloading a page.
+    '''
+    code = e.getcode() if callable(getattr(e, 'getcode', None)) else None
+    if code is not None:
+        retry_after = None
+        headers = getattr(e, 'hdrs', None) or getattr(e, 'headers', None)
+        if headers is not None:
+            retry_after = parse_retry_after(headers.get('Retry-After', None))
+        return (code in RETRY_STATUS_CODES, code in THROTTLE_STATUS_CODES, retry_after)
+    reason = getattr(e, 'reason', None)
+    args = getattr(e, 'args', None) or [None]
+    if isinstance(e, socket.timeout) or isinstance(reason, socket.timeout) or \
+            isinstance(args[0], socket.timeout):
+        # A timeout is the usual sign of an overloaded server, treat it as throttling
+        return (True, True, None)
+    if isinstance(e, (socket.error, IOError)) or isinstance(reason, (socket.error, IOError)):
+        return (True, False, None)
+    return (False, False, None)
+
+
+def backoff_delay(attempt, retry_after=None):
+    '''
+    Exponential backoff with full jitter, never shorter than Retry-After
+    '''
+    delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * (2 ** attempt)))
+    if retry_after:
+        delay = max(delay, min(retry_after, BACKOFF_MAX * 5))
+    return delay
+
+
+_executor = None
+_executor_size = None
+_executor_lock = Lock()
+
+
+def get_executor(max_workers):
+    '''
+    Executor running the detail page Workers of every identify call in the
+    process, so the number of concurrent downloads stays bounded no matter
+    how many books calibre identifies at once.
+    '''
+    global _executor, _executor_size
+    max_workers = max(1, int(max_workers))
+    with _executor_lock:
+        if _executor is None or _executor_size != max_workers:
+            if _executor is not None:
+                # Let the queued work finish on the old pool, new work goes to the new one
+                _executor.shutdown(wait=False)
+            _executor = ThreadPoolExecutor(max_workers=max_workers)
+            _executor_size = max_workers
+        return _executor
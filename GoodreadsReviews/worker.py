@@ -7,12 +7,12 @@ __license__   = 'GPL v3'
 __copyright__ = '2011, Grant Drake <grant.drake@gmail.com>, 2016-2020 updates by David Forrester <davidfor@internode.on.net>'
 __docformat__ = 'restructuredtext en'
 
-import socket, re, datetime
+import socket, re, datetime, traceback
 from collections import OrderedDict
-from threading import Thread
 import six
 from six import text_type as unicode
 
+from lxml import etree
 from lxml.html import fromstring, tostring
 
 from calibre.ebooks.metadata.book.base import Metadata
@@ -21,6 +21,11 @@ from calibre.utils.cleantext import clean_ascii_chars
 from calibre.utils.localization import canonicalize_lang
 
 import calibre_plugins.goodreads.config as cfg
+from calibre_plugins.goodreads import stats
+from calibre_plugins.goodreads.covers import get_cover_store
+from calibre_plugins.goodreads.fetcher import SingleFlight, get_fetcher
+from calibre_plugins.goodreads.idindex import get_identifier_index
+from calibre_plugins.goodreads.structured import StructuredData
 
 def clean_html(raw):
     from calibre.ebooks.chardet import xml_to_unicode
@@ -29,25 +34,181 @@ def clean_html(raw):
                                 resolve_entities=True, assume_utf8=True)[0])
 
 def parse_html(raw):
-    raw = clean_html(raw)
+    with stats.timer('clean_html'):
+        raw = clean_html(raw)
     from html5_parser import parse
-    return parse(raw)
+    with stats.timer('html5_parse'):
+        return parse(raw)
+
+def parse_html_stream(chunks):
+    '''
+    Feed the chunks of a book page to a DetailsPageScanner, the same way the
+    fetcher does, and return the scanner
+    '''
+    scanner = DetailsPageScanner()
+    for chunk in chunks:
+        if scanner.feed(chunk):
+            break
+    return scanner
+
+def node_text(node):
+    return tostring(node, method='text', encoding=unicode).strip()
+
+# Compiled once for the process, see DetailsPage
+XPATH_PAGE_TITLE = etree.XPath('//title')
+XPATH_ERROR_MESSAGE = etree.XPath('//*[@id="errorMessage"]')
+XPATH_METACOL = etree.XPath('//div[@id="metacol"]')
+XPATH_COVER = etree.XPath('//div[@class="bookCoverPrimary"]/a/img/@src')
+XPATH_GENRE_LINK = etree.XPath('.//a[contains(@href, "/genres/")]')
+XPATH_GENRES = etree.XPath('//div[@class="stacked"]/div/div/div[contains(@class, "bigBoxContent")]/div/div[@class="left"]')
+# Relative to the metacol div
+XPATH_TITLE = etree.XPath('./h1[@id="bookTitle"]')
+XPATH_SERIES = etree.XPath('./h2[@id="bookSeries"]/a')
+XPATH_AUTHORS = etree.XPath('./div[@id="bookAuthors"]')
+XPATH_DETAILS = etree.XPath('./div[@id="details"]')
+XPATH_RATING = etree.XPath('.//span[@itemprop="ratingValue"]')
+XPATH_RATING_COUNT = etree.XPath('.//*[@itemprop="ratingCount"]/@content')
+XPATH_DESCRIPTION = etree.XPath('.//div[@id="descriptionContainer"]/div[@id="description"]/span')
+# Relative to the details div
+XPATH_PUBLISHER = etree.XPath('./div[2]')
+XPATH_DATA_BOX_ROWS = etree.XPath('./div[@class="buttons"]/div[@id="bookDataBox"]/div')
+XPATH_CHILD_DIVS = etree.XPath('./div')
+
+
+class DetailsPageScanner(object):
+
+    '''
+    Incremental parse of a Goodreads book page as it is downloaded. Everything
+    the Worker extracts is in the metacol div and the genres box, so feed
+    returns True once both have been closed and the rest of the page (reviews,
+    quotes, footer and scripts) never needs to be read, decoded or parsed.
+    '''
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.parser = etree.HTMLPullParser(events=('end',), tag='div', encoding='utf-8')
+        self.seen_metacol = self.seen_genres = self.complete = False
+        self.bytes_fed = 0
+        self.parse_time = 0 if stats.enabled() else None
+
+    def feed(self, data):
+        if self.complete:
+            return True
+        self.bytes_fed += len(data)
+        if self.parse_time is not None:
+            start = stats.clock()
+        self.parser.feed(data)
+        for event, elem in self.parser.read_events():
+            if elem.get('id') == 'metacol':
+                self.seen_metacol = True
+            elif not self.seen_genres and 'bigBoxContent' in (elem.get('class') or '') and \
+                    XPATH_GENRE_LINK(elem):
+                self.seen_genres = True
+        self.complete = self.seen_metacol and self.seen_genres
+        if self.parse_time is not None:
+            self.parse_time += stats.clock() - start
+        return self.complete
+
+    def root(self):
+        '''
+        The parsed page, or None if it is not a book page we can use the
+        streamed tree for, in which case the page needs a full parse.
+        '''
+        if self.parse_time is not None:
+            stats.add_time('stream_parse', self.parse_time * 1000)
+            stats.count('stream_parse_bytes', self.bytes_fed)
+        try:
+            root = self.parser.close()
+        except etree.LxmlError:
+            return None
+        if not self.seen_metacol or root is None:
+            return None
+        return root.getroottree().getroot()
 
 
-class Worker(Thread): # Get details
+class DetailsPage(object):
 
     '''
-    Get book details from Goodreads book page in a separate thread
+    The sections of a Goodreads book page the fields are extracted from. Each
+    section is located once, and the rows of the bookDataBox are split into
+    their text once, so the parse methods of Worker never walk the whole tree.
     '''
 
-    def __init__(self, url, result_queue, browser, log, relevance, plugin, timeout=20):
-        Thread.__init__(self)
-        self.daemon = True
+    def __init__(self, root):
+        self.root = root
+        with stats.timer('structured'):
+            self.structured = StructuredData(root)
+        metacol = XPATH_METACOL(root)
+        self.metacol = metacol[0] if metacol else None
+        # Everything in metacol is searched from the whole page if it is missing
+        scope = self.metacol if self.metacol is not None else root
+        details = XPATH_DETAILS(self.metacol) if self.metacol is not None else []
+        self.details = details[0] if details else None
+        self.rating_nodes = self._find(XPATH_RATING, scope)
+        self.rating_count = self._find(XPATH_RATING_COUNT, scope)
+        self.description_nodes = self._find(XPATH_DESCRIPTION, scope)
+        # Each row is (row text, [cell nodes], [cell texts])
+        self.data_rows = []
+        if self.details is not None:
+            for row in XPATH_DATA_BOX_ROWS(self.details):
+                cells = XPATH_CHILD_DIVS(row)
+                self.data_rows.append((node_text(row), cells, [node_text(c) for c in cells]))
+
+    def _find(self, xpath, scope):
+        # Fall back to the whole page in case Goodreads moves the node out of metacol
+        ans = xpath(scope)
+        if not ans and scope is not self.root:
+            ans = xpath(self.root)
+        return ans
+
+    def metacol_xpath(self, xpath):
+        if self.metacol is None:
+            return []
+        return xpath(self.metacol)
+
+
+class DebugLog(object):
+
+    '''
+    Debug output of the Worker, only formatted when debug logging is enabled
+    in the plugin options. Arguments that are callables are only called then,
+    so nothing is serialised for a log nobody reads.
+    '''
+
+    def __init__(self, log, enabled):
+        self.log, self.enabled = log, enabled
+
+    def __call__(self, fmt, *args):
+        if self.enabled:
+            self.log.debug(fmt % tuple(a() if callable(a) else a for a in args))
+
+
+# Workers for the same book page at the same time share one download and parse
+_details_flight = SingleFlight()
+
+
+class Worker(object): # Get details
+
+    '''
+    Get book details from Goodreads book page. The run method is submitted to
+    the shared executor, see throttle.get_executor
+    '''
+
+    def __init__(self, url, result_queue, browser, log, relevance, plugin, timeout=20,
+                 settings=None):
         self.url, self.result_queue = url, result_queue
         self.log, self.timeout = log, timeout
         self.relevance, self.plugin = relevance, plugin
-        self.browser = browser.clone_browser()
+        # The options of the identify run, see config.get_settings
+        self.settings = settings if settings is not None else cfg.get_settings()
+        self.debug = DebugLog(log, self.settings.debug_logging)
+        # Connections come from the fetcher's pool, so the browser is shared
+        self.browser = browser
         self.cover_url = self.goodreads_id = self.isbn = None
+        # Field name -> where its value came from, see Worker._field
+        self.field_sources = {}
 
         lm = {
                 'eng': ('English', 'Englisch'),
@@ -66,14 +227,28 @@ class Worker(Thread): # Get details
 
     def run(self):
         try:
-            self.get_details()
+            mi, leader, shared = _details_flight.do(self.url, self.get_details)
         except:
             self.log.exception('get_details failed for url: %r'%self.url)
+            return
+        if mi is None:
+            return
+        if shared:
+            if not leader:
+                self.log.info('Sharing details already being downloaded: %r'%self.url)
+            mi = mi.deepcopy()
+        mi.source_relevance = self.relevance
+        # The page the details came from, a search result link or the book
+        # page of the goodreads id, see refresh.RefreshJob
+        mi.details_url = self.url
+        self.result_queue.put(mi)
 
     def get_details(self):
         try:
             self.log.info('Goodreads book url: %r'%self.url)
-            raw = self.browser.open_novisit(self.url, timeout=self.timeout).read().strip()
+            scanner = DetailsPageScanner()
+            raw = get_fetcher().fetch(self.browser, self.url, timeout=self.timeout,
+                                      log=self.log, consumer=scanner).strip()
         except Exception as e:
             if callable(getattr(e, 'getcode', None)) and \
                     e.getcode() == 404:
@@ -89,10 +264,9 @@ class Worker(Thread): # Get details
                 self.log.exception(msg)
             return
 
-        raw = raw.decode('utf-8', errors='replace')
         #open('c:\\goodreads.html', 'wb').write(raw)
 
-        if '<title>404 - ' in raw:
+        if b'<title>404 - ' in raw:
             self.log.error('URL malformed: %r'%self.url)
             return
 
@@ -101,7 +275,9 @@ class Worker(Thread): # Get details
 #             raw = clean_ascii_chars(xml_to_unicode(raw,
 #                                                strip_encoding_pats=True, resolve_entities=True)[0])
 #             root = fromstring(raw)
-            root = parse_html(raw)
+            root = scanner.root()
+            if root is None:
+                root = parse_html(raw.decode('utf-8', errors='replace'))
         except:
             msg = 'Failed to parse goodreads details page: %r'%self.url
             self.log.exception(msg)
@@ -111,7 +287,7 @@ class Worker(Thread): # Get details
             # Look at the <title> attribute for page to make sure that we were actually returned
             # a details page for a book. If the user had specified an invalid ISBN, then the results
             # page will just do a textual search.
-            title_node = root.xpath('//title')
+            title_node = XPATH_PAGE_TITLE(root)
             if title_node:
                 page_title = title_node[0].text.strip()
                 if page_title is None or page_title.find('search results for') != -1:
@@ -122,16 +298,18 @@ class Worker(Thread): # Get details
             self.log.exception(msg)
             return
 
-        errmsg = root.xpath('//*[@id="errorMessage"]')
+        errmsg = XPATH_ERROR_MESSAGE(root)
         if errmsg:
             msg = 'Failed to parse goodreads details page: %r'%self.url
-            msg += tostring(errmsg, method='text', encoding=unicode).strip()
+            msg += node_text(errmsg[0])
             self.log.error(msg)
             return
 
-        self.parse_details(root)
+        return self.parse_details(root)
 
     def parse_details(self, root):
+        with stats.timer('details_page'):
+            page = DetailsPage(root)
 #         self.log.error("parse_details: root='%s'" % root)
 #         self.log.error("parse_details: root='%s'" % tostring(root))
         try:
@@ -141,13 +319,13 @@ class Worker(Thread): # Get details
             goodreads_id = None
 
         try:
-            title = self.parse_title(root)
+            title = self._field(page, 'title', self.parse_title)
         except:
             self.log.exception('Error parsing title for url: %r'%self.url)
             title = None
 
         try:
-            authors = self.parse_authors(root)
+            authors = self._field(page, 'authors', self.parse_authors, self._filter_authors)
         except:
             self.log.exception('Error parsing authors for url: %r'%self.url)
             authors = []
@@ -159,12 +337,12 @@ class Worker(Thread): # Get details
             return
 
         mi = Metadata(title, authors)
-        self.log.info('parse_details - goodreads_id: {0}, mi: {1}'.format(goodreads_id,mi))
+        self.debug('parse_details - goodreads_id: %s, mi: %s', goodreads_id, mi)
         mi.set_identifier('goodreads', goodreads_id)
         self.goodreads_id = goodreads_id
 
         try:
-            (series, series_index) = self.parse_series(root)
+            (series, series_index) = self._field(page, 'series', self.parse_series)
 #             self.log.info("parse_series - series='%s', series_index='%s'" % (series, series_index))
             if series is not None:
 #                 self.log.info("setting series info - series='%s', series_index='%s'" % (series, series_index))
@@ -174,105 +352,126 @@ class Worker(Thread): # Get details
             self.log.exception('Error parsing series for url: %r'%self.url)
 
         try:
-            isbn = self.parse_isbn(root)
+            isbn = self._field(page, 'isbn', self.parse_isbn)
             if isbn is not None:
                 self.isbn = mi.isbn = isbn
         except:
             self.log.exception('Error parsing ISBN for url: %r'%self.url)
 
         try:
-            get_asin = cfg.plugin_prefs[cfg.STORE_NAME][cfg.KEY_GET_ASIN]
-            if get_asin is not None:
-                asin = self.parse_asin(root)
+            if self.settings.get_asin:
+                asin = self._field(page, 'asin', self.parse_asin)
                 if asin is not None:
                     mi.set_identifier('amazon', asin)
         except:
             self.log.exception('Error parsing ASIN for url: %r'%self.url)
 
         try:
-            mi.rating = self.parse_rating(root)
+            mi.rating = self._field(page, 'rating', self.parse_rating)
         except:
             self.log.exception('Error parsing ratings for url: %r'%self.url)
 
         try:
-            mi.comments = self.parse_comments(root)
+            mi.comments = self._field(page, 'comments', self.parse_comments,
+                                      sanitize_comments_html)
         except:
             self.log.exception('Error parsing comments for url: %r'%self.url)
 
         try:
-            self.cover_url = self.parse_cover(root)
+            self.cover_url = self._field(page, 'cover', self.parse_cover)
         except:
             self.log.exception('Error parsing cover for url: %r'%self.url)
         mi.has_cover = bool(self.cover_url)
 
         try:
-            tags = self.parse_tags(root)
+            tags = self._field(page, 'genres', self.parse_tags,
+                               lambda genres: self._convert_genres_to_calibre_tags(genres) or None)
             if tags is not None:
                 mi.tags = tags
         except:
             self.log.exception('Error parsing tags for url: %r'%self.url)
 
         try:
-            print(root)
-
             ## calibre-customize -b .
-            mi.publisher, mi.pubdate = self.parse_publisher_and_date(root)
+            mi.publisher, mi.pubdate = self._field(page, 'publication', self.parse_publisher_and_date)
 
 
             mi.set('#gr1',8.8)
             mi.set('#gr_ratingss',9.9)
 
 
-            mi.publisher = f"{mi.publisher} | {self.parse_rating_withcount(root)}" 
+            mi.publisher = f"{mi.publisher} | {self._field(page, 'rating_count', self.parse_rating_withcount, lambda count: self._rating_text(page, count))}" 
 
 
-            self.log.info("publisher: ", mi.publisher)
+            self.debug('publisher: %s', mi.publisher)
         except:
             self.log.exception('Error parsing publisher (i.e. goodreads ratings/reviews) for url: %r'%self.url)
 
         try:
-            lang = self._parse_language(root)
+            lang = self._field(page, 'language', self._parse_language, self._language_code)
             if lang is not None:
                 mi.language = lang
         except:
             self.log.exception('Error parsing language for url: %r'%self.url)
 
-        mi.source_relevance = self.relevance
+        self.debug('Field sources: %s', lambda: ', '.join(
+            '%s=%s' % item for item in sorted(self.field_sources.items())))
 
         if self.goodreads_id is not None:
             if self.isbn is not None:
                 self.plugin.cache_isbn_to_identifier(self.isbn, self.goodreads_id)
+                get_identifier_index().record(self.isbn, self.goodreads_id)
             if self.cover_url is not None:
                 self.plugin.cache_identifier_to_cover_url(self.goodreads_id,
                         self.cover_url)
+                get_cover_store().record_url(self.goodreads_id, self.cover_url)
 
         self.plugin.clean_downloaded_metadata(mi)
 
-        self.result_queue.put(mi)
+        return mi
+
+    def _field(self, page, name, parse, convert=None):
+        '''
+        The value of a field from the JSON embedded in the page if it has it,
+        otherwise scraped by parse(page). convert is applied to JSON values to
+        give them the form parse returns.
+        '''
+        with stats.timer('field:' + name):
+            value = page.structured.get(name)
+            if value is not None:
+                if convert is not None:
+                    value = convert(value)
+                if value is not None:
+                    self.field_sources[name] = page.structured.sources[name]
+                    stats.count('field_source:' + self.field_sources[name])
+                    return value
+            self.field_sources[name] = 'xpath'
+            stats.count('field_source:xpath')
+            return parse(page)
 
     def parse_goodreads_id(self, url):
         return re.search('/show/(\d+)', url).groups(0)[0]
 
-    def parse_title(self, root):
-        title_node = root.xpath('//div[@id="metacol"]/h1[@id="bookTitle"]')
+    def parse_title(self, page):
+        title_node = page.metacol_xpath(XPATH_TITLE)
         if not title_node:
             return None
         title_text = title_node[0].text.strip()
-        self.log.error("parse_title:: title_text='%s'" % title_text)
+        self.debug("parse_title:: title_text='%s'", title_text)
         return title_text
 
-    def parse_series(self, root):
+    def parse_series(self, page):
 #         self.log.error("parse_series: root='%s'" % tostring(root))
-        series_node = root.xpath('//div[@id="metacol"]/h2[@id="bookSeries"]/a')
+        series_node = page.metacol_xpath(XPATH_SERIES)
 #         self.log.error("parse_series: series_node='%s'" % series_node)
 #         self.log.error("parse_series: len(series_node)='%s'" % len(series_node))
 #         self.log.error("parse_series: series_node='%s'" % repr(series_node))
-        self.log.error("parse_series: series_node[0]='%s'" % tostring(series_node[0]))
 #         self.log.error("parse_series: series_node[0].text='%s'" % series_node[0].text)
         if not series_node:
             return (None, None)
+        self.debug("parse_series: series_node[0]='%s'", lambda: tostring(series_node[0], encoding=unicode))
         series_text = series_node[0].text.strip()
-        self.log.error("parse_series: series_text='%s'" % series_text)
+        self.debug("parse_series: series_text='%s'", series_text)
         if not series_text:
             return (None, None)
         # Series can look like:
@@ -280,7 +479,6 @@ class Worker(Thread): # Get details
         # "(Series Name #1)"
         # "(Series Name #05)"
         # "(Series Name 0.5)"
-        self.log.error("parse_series: series_text='%s'" % series_text)
         series_text = series_text.strip('(').strip(')')
         series = series_text
         series_index = None
@@ -288,12 +486,12 @@ class Worker(Thread): # Get details
 #             series_text = series_text[1:]
 #         if series_text[-1] == ')':
 #             series_text = series_text[:-1]
-        self.log.error("parse_series: series_text after stripping parantheses='%s'" % series_text)
+        self.debug("parse_series: series_text after stripping parantheses='%s'", series_text)
         series_split = series_text.split(' ')
         if len(series_split) > 1:
             series_index_str = series_split[-1]
             series_name = series_text[:-(len(series_index_str) + 1)]
-            self.log.error("parse_series: series_name='%s', series_index_str='%s'" % (series_name, series_index_str))
+            self.debug("parse_series: series_name='%s', series_index_str='%s'", series_name, series_index_str)
             series_index_str = series_index_str.strip('#')
             if series_index_str.find('-'):
                 # The series is specified as 1-3, 1-7 etc.
@@ -307,14 +505,14 @@ class Worker(Thread): # Get details
                 series_index = float(series_index)
                 series = series_name
             except ValueError:
-                self.log.error("parse_series: exception converting series_index: %s" % series_index)
+                self.debug("parse_series: exception converting series_index: %s", series_index)
                 # We have a series index which isn't really a series index
-        self.log.error("parse_series: returning - series_name='%s', series_index='%s'" % (series_name, series_index))
+        self.debug("parse_series: returning - series='%s', series_index='%s'", series, series_index)
         return (series, series_index)
 
-    def parse_authors(self, root):
+    def parse_authors(self, page):
         # Build a dict of authors with their contribution if any in values
-        div_authors = root.xpath('//div[@id="metacol"]/div[@id="bookAuthors"]')
+        div_authors = page.metacol_xpath(XPATH_AUTHORS)
         if not div_authors:
             return
         authors_html = tostring(div_authors[0], method='text', encoding=unicode).replace('\n','').strip()
@@ -322,7 +520,7 @@ class Worker(Thread): # Get details
             authors_html = authors_html[2:]
         authors_type_map = OrderedDict()
         for a in authors_html.split(','):
-            self.log.info('parse_authors - author: %s'%a)
+            self.debug('parse_authors - author: %s', a)
             author = a.strip()
             if author.startswith('more…'):
                 author = author[5:]
@@ -338,11 +536,14 @@ class Worker(Thread): # Get details
         # 1. They have no author type specified
         # 2. They have an author type of 'Goodreads Author'
         # 3. There are no authors from 1&2 and they have an author type of 'Editor'
-        get_all_authors = cfg.plugin_prefs[cfg.STORE_NAME][cfg.KEY_GET_ALL_AUTHORS]
+        return self._filter_authors(authors_type_map.items())
+
+    def _filter_authors(self, authors_and_contribs):
+        get_all_authors = self.settings.get_all_authors
         authors = []
         valid_contrib = None
-        for a, contrib in authors_type_map.items():
-            self.log.info('parse_authors - author: %s'%a)
+        for a, contrib in authors_and_contribs:
+            self.debug('parse_authors - author: %s', a)
             if get_all_authors:
                 authors.append(a)
             else:
@@ -357,26 +558,24 @@ class Worker(Thread): # Get details
                     break
         return authors
 
-    def parse_rating(self, root):
+    def parse_rating(self, page):
 #         rating_node = root.xpath('//div[@id="metacol"]/div[@id="bookMeta"]/span[@class="value rating"]/span')
-        rating_node = root.xpath('//span[@itemprop="ratingValue"]')
+        rating_node = page.rating_nodes
 #         rating_node = root.xpath('//div[@id="metacol"]/div[@id="details"]/div[@class="buttons"]/div[@id="bookDataBox"]/div/div[@itemprop="inLanguage"]')
-        self.log.info("parse_rating: rating_node=", rating_node)
+        self.debug("parse_rating: rating_node=%s", rating_node)
         if rating_node and len(rating_node) > 0:
             try:
-                self.log.info("parse_rating: have rating node - rating_node[0].text=", rating_node[0].text)
+                self.debug("parse_rating: have rating node - rating_node[0].text=%s", rating_node[0].text)
                 rating_text = rating_node[0].text
                 rating_value = float(rating_text)
                 return rating_value
             except:
-                self.log.info("parse_rating: Exception getting rating")
-                import traceback
-                traceback.print_stack()
+                self.debug("parse_rating: Exception getting rating: %s", traceback.format_exc)
                 return None
 
-    def parse_comments(self, root):
+    def parse_comments(self, page):
         # Look for description in a second span that gets expanded when interactively displayed [@id="display:none"]
-        description_node = root.xpath('//div[@id="descriptionContainer"]/div[@id="description"]/span')
+        description_node = page.description_nodes
         if description_node:
             desc = description_node[0] if len(description_node) == 1 else description_node[1]
             less_link = desc.xpath('a[@class="actionLinkLite"]')
@@ -388,42 +587,29 @@ class Worker(Thread): # Get details
             comments = sanitize_comments_html(comments)
             return comments
 
-    def parse_cover(self, root):
-        imgcol_node = root.xpath('//div[@class="bookCoverPrimary"]/a/img/@src')
+    def parse_cover(self, page):
+        imgcol_node = XPATH_COVER(page.root)
         if imgcol_node:
-            img_url = imgcol_node[0]
-            # Unfortunately Goodreads sometimes have broken links so we need to do
-            # an additional request to see if the URL actually exists
-            info = self.browser.open_novisit(img_url, timeout=self.timeout).info()
-            if int(info.get('Content-Length')) > 1000:
-                return img_url
-            else:
-                self.log.warning('Broken image for url: %s'%img_url)
-
-    def parse_isbn(self, root):
-        data_nodes = root.xpath('//div[@id="metacol"]/div[@id="details"]/div[@class="buttons"]/div[@id="bookDataBox"]/div')
-#         self.log.info("parse_isbn: data_nodes=", data_nodes)
-        if data_nodes:
-            for data_node in data_nodes:
-                id_type = tostring(data_node, method='text', encoding=unicode).strip()
-#                 self.log.info("parse_isbn: id_type=", id_type)
-                if 'ISBN' in id_type:
-#                     self.log.info("parse_isbn: Have ISBN node=", tostring(data_node))
-                    # The first line does not contain an ISBN or an ISBN13 so check the next line
-                    isbn_title_node = data_node.xpath('./div')[0]
-                    id_type = tostring(isbn_title_node, method='text', encoding=unicode).strip()
-#                     self.log.info("parse_isbn: id_type=", id_type)
-                    if id_type == 'ISBN':
-                        isbn10_data = tostring(data_node.xpath('./div')[1], method='text', encoding=unicode).strip()
-                        isbn13_pos = isbn10_data.find('ISBN13:')
-                        if isbn13_pos == -1:
-                            return isbn10_data[:10]
-                        else:
-                            return isbn10_data[isbn13_pos+8:isbn13_pos+21]
-                    elif id_type == 'ISBN13':
-                        # We have just an ISBN13, without an ISBN10
-                        return tostring(data_node.xpath('./div')[1], method='text', encoding=unicode).strip()
-                    break
+            # Goodreads sometimes have broken links, but those are only detected
+            # when the cover is actually downloaded, see Goodreads.download_cover
+            return imgcol_node[0]
+
+    def parse_isbn(self, page):
+        for row_text, cells, cell_texts in page.data_rows:
+            if 'ISBN' in row_text:
+                # The first line does not contain an ISBN or an ISBN13 so check the next line
+                id_type = cell_texts[0]
+                if id_type == 'ISBN':
+                    isbn10_data = cell_texts[1]
+                    isbn13_pos = isbn10_data.find('ISBN13:')
+                    if isbn13_pos == -1:
+                        return isbn10_data[:10]
+                    else:
+                        return isbn10_data[isbn13_pos+8:isbn13_pos+21]
+                elif id_type == 'ISBN13':
+                    # We have just an ISBN13, without an ISBN10
+                    return cell_texts[1]
+                break
 
 #         isbn_node = root.xpath('//div[@id="metacol"]/div[@id="details"]/div[@class="buttons"]/div[@id="bookDataBox"]/div[1]/div')
 #         self.log.info("parse_isbn: isbn_node=", isbn_node)
@@ -447,22 +633,12 @@ class Worker(Thread): # Get details
 #                 # We have just an ISBN13, without an ISBN10
 #                 return tostring(isbn_node[1], method='text', encoding=unicode).strip()
 
-    def parse_asin(self, root):
-        data_nodes = root.xpath('//div[@id="metacol"]/div[@id="details"]/div[@class="buttons"]/div[@id="bookDataBox"]/div')
-#         self.log.info("parse_asin: data_nodes=", data_nodes)
-        if data_nodes:
-            for data_node in data_nodes:
-                id_type = tostring(data_node, method='text', encoding=unicode).strip()
-#                 self.log.info("parse_isbn: id_type=", id_type)
-                if 'ASIN' in id_type:
-#                     self.log.info("parse_asin: Have ISBN node=", tostring(data_node))
-                    # The first line does not contain an ISBN or an ISBN13 so check the next line
-                    asin_title_node = data_node.xpath('./div')[0]
-                    id_type = tostring(asin_title_node, method='text', encoding=unicode).strip()
-#                     self.log.info("parse_asin: id_type=", id_type)
-                    if id_type == 'ASIN':
-                        return tostring(data_node.xpath('./div')[1], method='text', encoding=unicode).strip()
-                    break
+    def parse_asin(self, page):
+        for row_text, cells, cell_texts in page.data_rows:
+            if 'ASIN' in row_text:
+                if cell_texts[0] == 'ASIN':
+                    return cell_texts[1]
+                break
 
 #         asin_node = root.xpath('//div[@id="metacol"]/div[@id="details"]/div[@class="buttons"]/div[@id="bookDataBox"]/div[1]/div')
 #         if asin_node:
@@ -475,10 +651,10 @@ class Worker(Thread): # Get details
 #                 asin_data = tostring(asin_node[1], method='text', encoding=unicode).strip()
 #                 return asin_data
 
-    def parse_publisher_and_date(self, root):
+    def parse_publisher_and_date(self, page):
         publisher = None
         pub_date = None
-        publisher_node = root.xpath('//div[@id="metacol"]/div[@id="details"]/div[2]')
+        publisher_node = XPATH_PUBLISHER(page.details) if page.details is not None else []
         if publisher_node:
             # Publisher is specified within the div above with variations of:
             #  Published December 2003 by Books On Tape <nobr class="greyText">(first published 1982)</nobr>
@@ -514,10 +690,10 @@ class Worker(Thread): # Get details
                 pub_date = self._convert_date_text(pubdate_text)
         return (publisher, pub_date)
 
-    def parse_tags(self, root):
+    def parse_tags(self, page):
         # Goodreads does not have "tags", but it does have Genres (wrapper around popular shelves)
         # We will use those as tags (with a bit of massaging)
-        genres_node = root.xpath('//div[@class="stacked"]/div/div/div[contains(@class, "bigBoxContent")]/div/div[@class="left"]')
+        genres_node = XPATH_GENRES(page.root)
         #self.log.info("Parsing tags")
         if genres_node:
             #self.log.info("Found genres_node")
@@ -533,17 +709,8 @@ class Worker(Thread): # Get details
                 return calibre_tags
 
     def _convert_genres_to_calibre_tags(self, genre_tags):
-        # for each tag, add if we have a dictionary lookup
-        calibre_tag_lookup = cfg.plugin_prefs[cfg.STORE_NAME][cfg.KEY_GENRE_MAPPINGS]
-        calibre_tag_map = dict((k.lower(),v) for (k,v) in calibre_tag_lookup.items())
-        tags_to_add = list()
-        for genre_tag in genre_tags:
-            tags = calibre_tag_map.get(genre_tag.lower(), None)
-            if tags:
-                for tag in tags:
-                    if tag not in tags_to_add:
-                        tags_to_add.append(tag)
-        return list(tags_to_add)
+        # for each tag, add if we have a mapping, see genres.GenreMapper
+        return self.settings.genre_mapper.convert(genre_tags)
 
     def _convert_date_text(self, date_text):
         # Note that the date text could be "2003", "December 2003" or "December 10th 2003"
@@ -564,37 +731,42 @@ class Worker(Thread): # Get details
         from calibre.utils.date import utc_tz
         return datetime.datetime(year, month, day, tzinfo=utc_tz)
 
-    def _parse_language(self, root):
-        lang_node = root.xpath('//div[@id="metacol"]/div[@id="details"]/div[@class="buttons"]/div[@id="bookDataBox"]/div/div[@itemprop="inLanguage"]')
+    def _parse_language(self, page):
+        lang_node = [text for row_text, cells, cell_texts in page.data_rows
+                     for cell, text in zip(cells, cell_texts) if cell.get('itemprop') == 'inLanguage']
         if lang_node:
-            self.log.info("_parse_language: Have language node")
-            raw = tostring(lang_node[0], method='text', encoding=unicode).strip()
-            self.log.info("_parse_language: raw=", raw)
-            ans = self.lang_map.get(raw, None)
-            self.log.info("_parse_language: ans=", ans)
-            if ans:
-                return ans
-            ans = canonicalize_lang(raw)
-            self.log.info("_parse_language: ans=", ans)
-            if ans:
-                return ans
-
-    def parse_rating_withcount(self, root):
-        rating_node = root.xpath('//span[@itemprop="ratingValue"]')
-        rating_count = root.xpath('//*[@itemprop="ratingCount"]/@content')
+            self.debug("_parse_language: Have language node")
+            return self._language_code(lang_node[0])
+
+    def _language_code(self, raw):
+        self.debug("_parse_language: raw=%s", raw)
+        ans = self.lang_map.get(raw, None)
+        self.debug("_parse_language: ans=%s", ans)
+        if ans:
+            return ans
+        ans = canonicalize_lang(raw)
+        self.debug("_parse_language: ans=%s", ans)
+        if ans:
+            return ans
+
+    def _rating_text(self, page, rating_count):
+        rating = page.structured.get('rating')
+        if rating is None:
+            return None
+        return "Rating: %.2f | Reviews: %d" % (rating, rating_count)
+
+    def parse_rating_withcount(self, page):
+        rating_node = page.rating_nodes
+        rating_count = page.rating_count
         
-        self.log.info("parse_rating_withcount: rating_node=", rating_node)
-        self.log.info("parse_rating_withcount: rating_count=", rating_count)
+        self.debug("parse_rating_withcount: rating_node=%s", rating_node)
+        self.debug("parse_rating_withcount: rating_count=%s", rating_count)
         if rating_node and len(rating_node) > 0:
             try:
-                self.log.info("parse_rating_withcount: have rating node - rating_node[0].text.strip()=", rating_node[0].text.strip())
-                self.log.info("parse_rating_withcount: have rating count - rating_count[0]=", rating_count[0])
                 rating_text = "Rating: " + rating_node[0].text.strip() + " | Reviews: " + rating_count[0]
-                self.log.info("parse_rating_withcount: rating_text=", rating_text)
+                self.debug("parse_rating_withcount: rating_text=%s", rating_text)
                 return rating_text
             except:
-                self.log.info("parse_rating_withcount: Exception getting rating")
-                import traceback
-                traceback.print_stack()
+                self.debug("parse_rating_withcount: Exception getting rating: %s", traceback.format_exc)
                 return None
                 
\ No newline at end of file
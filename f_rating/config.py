@@ -25,6 +25,10 @@ prefs = JSONConfig('plugins/interface_demo')
 
 # Set defaults
 prefs.defaults['Floating rating'] = 'Floating rating!'
+# Run on the books whose publisher was changed, e.g. by a metadata download
+prefs.defaults['auto_run'] = False
+# library id -> time of the last run, books modified before it are done
+prefs.defaults['watermarks'] = {}
 
 class ConfigWidget(QWidget):
 
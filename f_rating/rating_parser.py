@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# vim:fileencoding=UTF-8:ts=4:sw=4:sta:et:sts=4:ai
+from __future__ import (unicode_literals, division, absolute_import,
+                        print_function)
+
+__license__   = 'GPL v3'
+__copyright__ = '2019, Mod'
+__docformat__ = 'restructuredtext en'
+
+# Parser for the rating the GoodreadsReviews source appends to the publisher:
+#   "Publisher | Rating: 4.26 | Reviews: 1234"
+# No calibre imports, so the checks at the bottom run with plain python:
+#   python rating_parser.py [count]
+
+import re
+from collections import namedtuple
+
+# Quick test before the full regular expression, most publishers have no
+# rating. Older versions of the source wrote "Tor|Rating:4.1", and a
+# publisher merely named "Rating Press" or "Tor | Ratings" has none.
+RATING_MARKER = re.compile(r'\|\s*Rating\s*(?::|\||$)', re.UNICODE)
+
+RATED_PUBLISHER = re.compile(
+    r'^(?P<publisher>.*?)\s*\|\s*Rating\s*:?\s*(?P<rating>\d+(?:\.\d+)?)?\s*'
+    r'(?:\|\s*Reviews\s*:\s*(?P<reviews>\d[\d,.]*)?\s*)?$', re.UNICODE | re.DOTALL)
+
+# publisher is None if empty (or "None", what the source writes for a book
+# without a publisher), rating a float and reviews an int, both None if missing
+RatedPublisher = namedtuple('RatedPublisher', 'publisher rating reviews')
+
+
+def has_rating(value):
+    '''
+    True if the publisher field has the rating suffix, even one
+    parse_publisher cannot read
+    '''
+    return bool(value) and RATING_MARKER.search(value) is not None
+
+
+def parse_publisher(value):
+    '''
+    The RatedPublisher for a publisher field, None if it has no rating
+    '''
+    if not has_rating(value):
+        return None
+    match = RATED_PUBLISHER.match(value)
+    if match is None:
+        return None
+    publisher, rating, reviews = match.groups()
+    publisher = publisher.strip()
+    return RatedPublisher(
+        publisher if publisher and publisher != 'None' else None,
+        float(rating) if rating else None,
+        # Thousands separators, either kind
+        int(reviews.replace(',', '').replace('.', '')) if reviews else None)
+
+
+if __name__ == '__main__':
+    import random, sys, time
+
+    def legacy_parse(pub_org):
+        # The string slicing used before, for the benchmark
+        pos = pub_org.find('| Rating')
+        pub = pub_org[0:pos-1]
+        rating = rev = None
+        rat = pub_org[pos+8:] if len(pub_org) > pos+8 else None
+        if rat:
+            pos2 = rat.find(':')
+            pos3 = rat.find('| Reviews')
+            if pos2 > -1:
+                rating = rat[pos2+1:pos3].replace('|', '').strip()
+                pos4 = rat[pos2+1:].find(':')
+                rev = rat[pos4+2:].strip()
+                pub = pub_org[0:pos]
+        return (pub, rating, rev)
+
+    examples = {
+        'Ace | Rating: 4.26 | Reviews: 1234': RatedPublisher('Ace', 4.26, 1234),
+        'Ace Books|Rating:4|Reviews:1,234,567': RatedPublisher('Ace Books', 4.0, 1234567),
+        'Tor | Rating: 4.1': RatedPublisher('Tor', 4.1, None),
+        'Tor | Rating: 4.1 | Reviews:': RatedPublisher('Tor', 4.1, None),
+        'Tor | Rating': RatedPublisher('Tor', None, None),
+        'None | Rating: 3.00 | Reviews: 5': RatedPublisher(None, 3.0, 5),
+        '| Rating: 3.00 | Reviews: 5': RatedPublisher(None, 3.0, 5),
+        'Simon | Schuster | Rating: 3.5 | Reviews: 12': RatedPublisher('Simon | Schuster', 3.5, 12),
+        'Tor': None,
+        'Rating Press': None,
+        'Ratings Books': None,
+        'Tor | Ratings': None,
+        'Rating Press | Rating: 4.5 | Reviews: 10': RatedPublisher('Rating Press', 4.5, 10),
+        'Tor | Rating: high': None,
+        '': None,
+        None: None,
+    }
+    for value, expected in examples.items():
+        assert parse_publisher(value) == expected, (value, parse_publisher(value), expected)
+
+    # Round trip over a synthetic corpus, in the formats the source has written
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    rng = random.Random(1)
+    words = ['Ace', 'Tor', 'Penguin', 'Random', 'House', 'Books', 'Éditions', 'Gallimard',
+             'St.', "Martin's", 'Press', '&', '|', '-', 'Verlag', 'Ltd', '2019', 'Rating',
+             'Ratings']
+    corpus, expected = [], []
+    for i in range(count):
+        publisher = ' '.join(rng.choice(words) for j in range(rng.randint(0, 4))).strip(' |')
+        rating = round(rng.uniform(0, 5), 2)
+        reviews = rng.choice((None, rng.randint(0, 5000000)))
+        kind = rng.randint(0, 9)
+        if kind == 0:
+            # A publisher never downloaded with a rating. One ending in
+            # "| Rating" can't be told from a rating suffix, it is left out.
+            if not has_rating(publisher):
+                corpus.append(publisher)
+                expected.append(None)
+            continue
+        suffix = ' | Rating: %.2f' % rating
+        if reviews is not None:
+            suffix += ' | Reviews: ' + ('{:,}'.format(reviews) if kind == 2 else '%d' % reviews)
+        if kind == 1:
+            suffix = suffix.replace(' | ', '|').replace(': ', ':')
+        corpus.append((publisher or 'None') + suffix)
+        expected.append(RatedPublisher(publisher or None, rating, reviews))
+    results = [parse_publisher(value) for value in corpus]
+    for value, result, wanted in zip(corpus, results, expected):
+        assert result == wanted, (value, result, wanted)
+        if result is not None:
+            assert isinstance(result.rating, float) and 0 <= result.rating <= 5, value
+            assert result.reviews is None or isinstance(result.reviews, int), value
+
+    rated = [value for value in corpus if has_rating(value)]
+    for name, fn in (('legacy', lambda: [legacy_parse(v) for v in rated]),
+                     ('parse_publisher', lambda: [parse_publisher(v) for v in rated])):
+        start = time.time()
+        fn()
+        elapsed = time.time() - start
+        print('%-16s %8d values %8.1fms %10.0f/s' % (name, len(rated), elapsed * 1000,
+                                                   len(rated) / max(elapsed, 1e-9)))
+    print('%d checks passed' % (len(examples) + len(corpus)))
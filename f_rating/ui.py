@@ -4,7 +4,7 @@ from __future__ import (unicode_literals, division, absolute_import,
                         print_function)
 from PyQt5 import QtGui, QtCore, QtWidgets
 from PyQt5.QtWidgets import QAbstractItemView
-from PyQt5.Qt import QMenu, QToolButton, QPixmap, Qt, QDialog, QProgressDialog
+from PyQt5.Qt import QMenu, QToolButton, QPixmap, Qt, QDialog, QProgressDialog, QTimer, pyqtSignal
                         
 __license__   = 'GPL v3'
 __copyright__ = '2019, Mod'
@@ -15,7 +15,8 @@ try:
 except NameError:
   pass # load_translations() added in calibre 1.9
 
-import sys
+from threading import Event, Thread
+
 
 if False:
     # This is here to keep my python error checker from complaining about
@@ -27,6 +28,33 @@ if False:
 from calibre.gui2.actions import InterfaceAction
 from calibre.gui2 import error_dialog, info_dialog
 
+from calibre_plugins.F_rating.config import prefs
+from calibre_plugins.F_rating.rating_parser import has_rating, parse_publisher
+
+# Milliseconds to wait for more publisher changes before an automatic run,
+# a metadata download writes its books a few at a time
+AUTO_RUN_DELAY = 3000
+# Books written per transaction, the progress dialog is updated in between
+WRITE_BATCH = 500
+# Publishers parsed between two progress updates of the scan
+SCAN_PROGRESS_STEP = 100
+
+class RatingJob(object):
+    # State of one run, see InterfacePlugin.change
+
+    def __init__(self, api, started, watermark, quiet):
+        self.api, self.started, self.watermark = api, started, watermark
+        # Reported in the status bar instead of dialogs
+        self.quiet = quiet
+        self.abort = Event()
+        self.progress = None
+        self.maps = ({}, {}, {})
+        # Publishers with a rating the parser could not read
+        self.unparsed = 0
+        self.pending = []
+        self.written = 0
+        self.error = None
+
 class InterfacePlugin(InterfaceAction):
     name = 'F_rating'
     # Declare the main action associated with this plugin
@@ -37,6 +65,13 @@ class InterfacePlugin(InterfaceAction):
             _('Run F_rating to set decimal rating'), 'Ctrl+Shift+F1')
     action_type = 'current'
     popup_type = QToolButton.MenuButtonPopup
+
+    # Emitted from calibre's database event thread with the ids of books
+    # whose publisher changed
+    publishers_changed = pyqtSignal(object)
+    # Emitted from the scan thread of a run
+    scan_progress = pyqtSignal(int, int)
+    scan_finished = pyqtSignal(object)
     
     def start_change(self):
         check=False
@@ -47,6 +82,10 @@ class InterfacePlugin(InterfaceAction):
         else: # there is an column gr1
             self.change()
     
+    def start_incremental(self):
+        if self.check_column():
+            self.change(incremental=True)
+
     def start_column(self):
         check=self.check_column()
         if check:
@@ -81,59 +120,244 @@ class InterfacePlugin(InterfaceAction):
                     check= True
         return(check)
           
-    def change(self):   
-        puber = self.db.FIELD_MAP['publisher']
+    def collect_ratings(self, api, book_ids=None, progress=None, abort=None):
+        '''
+        Returns ((publisher, rating, reviews), unparsed): {book id: new
+        value} maps of the books whose publisher has a rating, of the whole
+        library or only of book_ids, and the number of publishers with a
+        rating that could not be read. progress is called with (done, total)
+        publishers, and the scan stops early once abort is set.
+        '''
+        publishers, ratings, reviews = {}, {}, {}
+        unparsed = 0
+        if book_ids is None:
+            # Only the distinct publisher names with a rating are parsed, once,
+            # and the result goes to every book with that publisher
+            groups = [(pub_org, api.books_for_field('publisher', pub_id))
+                      for pub_id, pub_org in api.get_id_map('publisher').items()
+                      if has_rating(pub_org)]
+        else:
+            by_publisher = {}
+            for id, pub_org in api.all_field_for('publisher', book_ids).items():
+                if has_rating(pub_org):
+                    by_publisher.setdefault(pub_org, []).append(id)
+            groups = list(by_publisher.items())
+        for start in range(0, len(groups), SCAN_PROGRESS_STEP):
+            if abort is not None and abort.is_set():
+                break
+            if progress is not None:
+                progress(start, len(groups))
+            for pub_org, ids in groups[start:start + SCAN_PROGRESS_STEP]:
+                parsed = parse_publisher(pub_org)
+                if parsed is None:
+                    # "| Rating" without a rating the parser understands,
+                    # left as it is rather than cutting the publisher short
+                    unparsed += 1
+                    continue
+                # Typed values, the rating columns are floats
+                for id in ids:
+                    publishers[id]=parsed.publisher
+                    ratings[id]=parsed.rating
+                    reviews[id]=parsed.reviews
+        return ((publishers, ratings, reviews), unparsed)
+
+    def changed_since_last_run(self, api):
+        # The books modified since the last run, None if there was no run yet
+        from calibre.utils.date import parse_date
+        watermark = prefs['watermarks'].get(api.library_id, None)
+        if watermark is None:
+            return None
+        watermark = parse_date(watermark)
+        modified = api.all_field_for('last_modified', api.all_book_ids())
+        return [id for id, when in modified.items() if when is not None and when >= watermark]
+
+    def set_watermark(self, api, when):
+        watermarks = dict(prefs['watermarks'])
+        watermarks[api.library_id] = when.isoformat()
+        prefs['watermarks'] = watermarks
+
+    def change(self, incremental=False, book_ids=None, quiet=False):
+        '''
+        Split the rating out of the publisher of all books, of the books
+        modified since the last run (incremental) or of book_ids. The
+        publishers are parsed on a thread and the books written in batches
+        behind a progress dialog, so calibre stays responsive. quiet runs,
+        the automatic ones, work the same without the dialog and are
+        reported in the status bar.
+        '''
+        from calibre.utils.date import utcnow
+        if self.job is not None:
+            return
+        api = self.db.new_api
+        # Only whole runs move the watermark
+        job = self.job = RatingJob(api, utcnow(), incremental or book_ids is None, quiet)
         print (_('searching ..'))
-        tel=0
-        for record in self.db.data:
-            if sys.version_info.major==2:
-                #print("versie 2.x")
-                pub_org=str(record[puber]).encode('utf8')
-                #pub_org=record[puber]
-                pub_org = pub_org.decode('utf8','ignore')
-            else:
-                pub_org=str(record[puber])
-            pos=pub_org.find('| Rating') # PrB.rating
-
-            if pos>0:
-                print ('pos:',pos)
-                pub=pub_org[0:pos-1] # part of publisher
-                #print ('len:',len(pub_org),'-', pos+11)
-                if len(pub_org)>pos+8:
-                    rat=pub_org[pos+8:] # part of floatrating
-                else:
-                    rat=None
-                #print ('pub:',pub)
-                #print ('rat:',rat)
-                if rat:
-                    pos2=rat.find(':')
-                    pos3=rat.find('| Reviews')
-                    #print ('pos2:',pos2)
-                    if pos2>-1:
-                        rating=rat[pos2+1:]
-                        rating=rat[pos2+1:pos3].replace("|","").strip()
-                        pos4=rat[pos2+1:].find(':')
-                        rev=rat[pos4+2:].strip()
-                        pub=pub_org[0:pos] # part of publisher
-                        #print ('rat2:',rat) 
-                        #print ('pub2:',pub)
-                        
-                id=record[0]
-                print('id1:', id)
-                mi = self.db.get_metadata(id, index_is_id=True)
-                print ('mi:', mi)
-                mi.publisher=pub
-
-                print( mi.publisher)
-
-                mi.set('#gr1',rating)
-                mi.set('#gr2', rev)
-                self.db.set_metadata(id, mi, force_changes=True)
-                tel+=1
-        info_dialog(self.gui, _('Database Update'),
-                _('Finished extracting rating from publisherfield \n- for a total of %d books')%tel,
-                show=True)
-    
+        if incremental:
+            book_ids = self.changed_since_last_run(api)
+        if not quiet:
+            job.progress = QProgressDialog(_('Searching publishers ..'), _('Cancel'), 0, 0, self.gui)
+            job.progress.setWindowTitle(_('F_rating'))
+            job.progress.setWindowModality(Qt.WindowModal)
+            job.progress.setMinimumDuration(0)
+            job.progress.setAutoClose(False)
+            job.progress.canceled.connect(job.abort.set)
+            job.progress.show()
+        scan = Thread(target=self.scan, args=(job, book_ids), name='F_rating scan')
+        scan.daemon = True
+        scan.start()
+
+    def scan(self, job, book_ids):
+        # On the scan thread, reading the library through new_api is thread safe
+        try:
+            result = self.collect_ratings(job.api, book_ids, progress=self.scan_progress.emit,
+                                          abort=job.abort)
+        except Exception:
+            import traceback
+            result = traceback.format_exc()
+        self.scan_finished.emit(result)
+
+    def on_scan_progress(self, done, total):
+        job = self.job
+        if job is not None and job.progress is not None:
+            job.progress.setMaximum(total)
+            job.progress.setValue(done)
+
+    def on_scan_finished(self, result):
+        job = self.job
+        if job is None:
+            return
+        if not isinstance(result, tuple):
+            job.error = result
+            return self.finish_job()
+        self.scan_done(result)
+        if job.progress is not None:
+            job.progress.setLabelText(_('Updating %d books ..') % len(job.pending))
+            job.progress.setMaximum(len(job.pending))
+            job.progress.setValue(0)
+        QTimer.singleShot(0, self.write_next_batch)
+
+    def scan_done(self, result):
+        self.job.maps, self.job.unparsed = result
+        self.job.pending = list(self.job.maps[0])
+
+    def write_next_batch(self):
+        # One batch per event loop turn, so the dialog repaints and can be canceled
+        job = self.job
+        if job.abort.is_set() or not job.pending:
+            return self.finish_job()
+        try:
+            self.write_batch(job)
+        except Exception:
+            import traceback
+            job.error = traceback.format_exc()
+            return self.finish_job()
+        if job.progress is not None:
+            job.progress.setValue(job.written)
+        QTimer.singleShot(0, self.write_next_batch)
+
+    def write_batch(self, job):
+        ids = job.pending[:WRITE_BATCH]
+        del job.pending[:WRITE_BATCH]
+        job.written += self.write_ratings(*[dict((id, values[id]) for id in ids) for values in job.maps])
+
+    def finish_job(self):
+        job, self.job = self.job, None
+        if job.progress is not None:
+            job.progress.close()
+        if job.error is not None:
+            return error_dialog(self.gui, _('Database Update'),
+                    _('Extracting rating from publisherfield failed'),
+                    det_msg=job.error, show=True)
+        canceled = job.abort.is_set()
+        if job.watermark and not canceled:
+            # Writes made by this run are after the watermark, they are
+            # looked at again next time but have no rating to split
+            self.set_watermark(job.api, job.started)
+        msg = _('Finished extracting rating from publisherfield \n- for a total of %d books')%job.written
+        if canceled:
+            msg = _('Canceled extracting rating from publisherfield \n- after %d of %d books')%(
+                    job.written, len(job.maps[0]))
+        if job.unparsed:
+            msg += _('\n- %d publishers had a rating that could not be read')%job.unparsed
+        if job.quiet:
+            self.gui.status_bar.show_message(msg.replace('\n', ' '), 5000)
+        else:
+            info_dialog(self.gui, _('Database Update'), msg, show=True)
+
+    def write_ratings(self, publishers, ratings, reviews):
+        '''
+        Set the publisher, #gr1 and #gr2 of the books in one transaction,
+        one set_field call per column instead of a get_metadata and
+        set_metadata per book. Returns the number of books changed.
+        '''
+        if not publishers:
+            return 0
+        api = self.db.new_api
+        if self.watched is not None and prefs['auto_run']:
+            # So the publisher event of these writes does not start a run
+            self.own_writes.update(publishers)
+        with api.write_lock, api.backend.conn:
+            api.set_field('publisher', publishers)
+            api.set_field('#gr1', ratings)
+            api.set_field('#gr2', reviews)
+        # The library view does not see changes made through new_api
+        self.gui.library_view.model().refresh_ids(list(publishers))
+        return len(publishers)
+
+    def toggle_auto_run(self, checked):
+        prefs['auto_run'] = checked
+        self.own_writes.clear()
+
+    def watch_library(self, db):
+        # Listen for publisher changes in the library db, see on_db_event
+        if self.watched is not None:
+            try:
+                self.watched.remove_listener(self.db_listener)
+            except Exception:
+                pass
+            self.watched = None
+        self.own_writes.clear()
+        api = db.new_api
+        if hasattr(api, 'add_listener'): # calibre 4.x and later
+            api.add_listener(self.db_listener)
+            self.watched = api
+
+    def on_db_event(self, event_type, library_id, event_data):
+        # Called on calibre's event thread, the work is done on the GUI thread
+        if not prefs['auto_run']:
+            return
+        from calibre.db.listeners import EventType
+        if event_type == EventType.metadata_changed and event_data[0] == 'publisher':
+            self.publishers_changed.emit(set(event_data[1]))
+
+    def queue_auto_run(self, book_ids):
+        # Our own writes come back as publisher changes too, see write_ratings
+        own = book_ids & self.own_writes
+        self.own_writes -= own
+        book_ids -= own
+        if not book_ids:
+            return
+        self.pending_ids |= book_ids
+        # Restarted by every change, so a whole download is done in one go
+        self.auto_timer.start(AUTO_RUN_DELAY)
+
+    def auto_run(self):
+        if self.job is not None:
+            # Wait for the run going on to finish
+            return self.auto_timer.start(AUTO_RUN_DELAY)
+        book_ids, self.pending_ids = self.pending_ids, set()
+        if not book_ids or not prefs['auto_run']:
+            return
+        # Never creates the columns, that needs a restart
+        if self.check_gr():
+            self.change(book_ids=book_ids, quiet=True)
+
+    def initialization_complete(self):
+        self.watch_library(self.gui.current_db)
+
+    def library_changed(self, db):
+        self.watch_library(db)
+
     def genesis(self):
         # This method is called once per plugin, do initial setup here
 
@@ -159,10 +383,30 @@ class InterfacePlugin(InterfaceAction):
         from functools import partial
         for (short, tooltip, action) in self.menudata:
             self.create_menu_action(m, short, short, None, None, tooltip, partial(action,self), None)
+        m.addSeparator()
+        self.auto_run_action = m.addAction(_('Run after metadata download'))
+        self.auto_run_action.setToolTip(_('Set decimal rating of the books whose publisher changed'))
+        self.auto_run_action.setCheckable(True)
+        self.auto_run_action.setChecked(prefs['auto_run'])
+        self.auto_run_action.toggled.connect(self.toggle_auto_run)
         self.qaction.setMenu(m) 
+
+        self.job = None
+        self.scan_progress.connect(self.on_scan_progress, type=Qt.QueuedConnection)
+        self.scan_finished.connect(self.on_scan_finished, type=Qt.QueuedConnection)
+        self.watched = None
+        self.pending_ids = set()
+        self.own_writes = set()
+        # Kept here as the database may only hold a weak reference to it
+        self.db_listener = self.on_db_event
+        self.auto_timer = QTimer(self)
+        self.auto_timer.setSingleShot(True)
+        self.auto_timer.timeout.connect(self.auto_run)
+        self.publishers_changed.connect(self.queue_auto_run, type=Qt.QueuedConnection)
                 
     menudata = (
         (_("Set decimal rating"), _("Search end set database for decimal_ratings"),start_change),
+        (_("Set decimal rating of changed books"), _("Only the books modified since the last run"),start_incremental),
         (_("Check and create custom column"),_(" Create custom column"),start_column)
        
         )